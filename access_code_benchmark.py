@@ -0,0 +1,48 @@
+import argparse
+import os
+import time
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+import access_qrcode as qr
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Скорость проверки подписанных кодов доступа'
+    )
+    parser.add_argument('--codes', type=int, default=100000)
+    args = parser.parse_args()
+
+    load_dotenv()
+    if not os.getenv('ACCESS_CODE_KEYS'):
+        os.environ['ACCESS_CODE_KEYS'] = 'benchmark:benchmark-secret'
+
+    today = date.today()
+    access_codes = [
+        qr.create_access_code(
+            booking_number,
+            str(booking_number % 4 + 1),
+            (today - timedelta(days=1)).isoformat(),
+            (today + timedelta(days=30)).isoformat(),
+        )
+        for booking_number in range(args.codes)
+    ]
+
+    started_at = time.perf_counter()
+    valid_count = sum(
+        qr.verify_access_code(access_code, today) is not None
+        for access_code in access_codes
+    )
+    elapsed = time.perf_counter() - started_at
+
+    print(f'Проверено кодов: {args.codes}, действительных: {valid_count}')
+    print(
+        f'{args.codes / elapsed:.0f} кодов в секунду, '
+        f'{elapsed / args.codes * 1e6:.1f} мкс на код'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,138 @@
-from datetime import datetime
-from pathlib import Path
-
-import qrcode
-
-
-def create_access_code(passport_series_and_number: str) -> str:
-    """Return access code."""
-    access_code = (
-        f'{passport_series_and_number}'
-        f'{int(datetime.now().timestamp())}'
-    )
-    return access_code
-
-
-def create_qrcode(code: str) -> str:
-    """Create QR-code image and return it's path."""
-    qrcode_image = qrcode.make(code)
-    qrcodes_directory = './qrcodes/'
-    Path(qrcodes_directory).mkdir(exist_ok=True)
-    qrcode_image_path = (
-        f'{qrcodes_directory}/qr{int(datetime.now().timestamp())}.jpg'
-    )
-    qrcode_image.save(qrcode_image_path)
-    return qrcode_image_path
+import hashlib
+import hmac
+import os
+from base64 import urlsafe_b64encode
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from functools import lru_cache
+from io import BytesIO
+from typing import Dict, Optional
+
+import qrcode
+
+SIGNATURE_LENGTH = 12
+
+_qrcode_executor = None
+
+
+@lru_cache(maxsize=4)
+def parse_access_code_keys(keys_setting: str) -> Dict[str, bytes]:
+    """Parse keys from ACCESS_CODE_KEYS formatted as "id:secret,id:secret"."""
+    keys = {}
+    for key_setting in keys_setting.split(','):
+        key_id, secret = key_setting.strip().split(':', 1)
+        keys[key_id] = secret.encode()
+    return keys
+
+
+def get_access_code_keys() -> Dict[str, bytes]:
+    return parse_access_code_keys(os.environ['ACCESS_CODE_KEYS'])
+
+
+def get_signing_key_id() -> str:
+    """Return ACCESS_CODE_KEY_ID or the last key id of ACCESS_CODE_KEYS."""
+    keys = get_access_code_keys()
+    key_id = os.getenv('ACCESS_CODE_KEY_ID', default=list(keys)[-1])
+    if key_id not in keys:
+        raise ValueError(
+            f'ACCESS_CODE_KEY_ID {key_id} is not in ACCESS_CODE_KEYS'
+        )
+    return key_id
+
+
+def sign_access_payload(key: bytes, payload: str) -> str:
+    signature = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return urlsafe_b64encode(signature[:SIGNATURE_LENGTH]).decode()
+
+
+def create_access_code(booking_id: int, storage_id: str, start_date: str,
+                       end_date: str) -> str:
+    """Return signed access code.
+
+    The code carries booking, storage and validity dates and is signed with
+    the key ACCESS_CODE_KEY_ID (the last key of ACCESS_CODE_KEYS by default).
+    """
+    keys = get_access_code_keys()
+    key_id = get_signing_key_id()
+    valid_from = date.fromisoformat(start_date).strftime('%Y%m%d')
+    valid_to = date.fromisoformat(end_date).strftime('%Y%m%d')
+    payload = f'{key_id}.{booking_id}.{storage_id}.{valid_from}.{valid_to}'
+    return f'{payload}.{sign_access_payload(keys[key_id], payload)}'
+
+
+def verify_access_code(access_code: str,
+                       check_date: date = None) -> Optional[dict]:
+    """Return access code data if it is signed and valid at check_date."""
+    payload, _, signature = access_code.rpartition('.')
+    try:
+        key_id, booking_id, storage_id, valid_from, valid_to = (
+            payload.split('.')
+        )
+    except ValueError:
+        return None
+    key = get_access_code_keys().get(key_id)
+    if key is None:
+        return None
+    if not hmac.compare_digest(sign_access_payload(key, payload), signature):
+        return None
+
+    check_day = (check_date or date.today()).strftime('%Y%m%d')
+    if not valid_from <= check_day <= valid_to:
+        return None
+    return {
+        'booking_id': booking_id,
+        'storage_id': storage_id,
+        'valid_from': valid_from,
+        'valid_to': valid_to,
+    }
+
+
+def create_qrcode(code: str, image_format: str = 'PNG',
+                  box_size: int = 10) -> bytes:
+    """Render QR-code image in memory and return it's bytes."""
+    qrcode_image = qrcode.make(code, box_size=box_size)
+    image_buffer = BytesIO()
+    qrcode_image.save(image_buffer, format=image_format)
+    return image_buffer.getvalue()
+
+
+def start_qrcode_workers(workers_count: int) -> None:
+    """Start QR-code rendering processes and wait until they are ready."""
+    global _qrcode_executor
+    _qrcode_executor = ProcessPoolExecutor(max_workers=workers_count)
+    warmup_futures = [
+        _qrcode_executor.submit(create_qrcode, 'warmup')
+        for _ in range(workers_count)
+    ]
+    for future in warmup_futures:
+        future.result()
+
+
+def stop_qrcode_workers() -> None:
+    global _qrcode_executor
+    if _qrcode_executor is not None:
+        _qrcode_executor.shutdown(wait=True)
+        _qrcode_executor = None
+
+
+def render_qrcode(code: str, image_format: str = 'PNG',
+                  box_size: int = 10) -> Future:
+    """Return future with QR-code image bytes rendered in a worker process.
+
+    Renders in the calling thread if the workers are not started or their
+    pool is broken.
+    """
+    if _qrcode_executor is not None:
+        try:
+            return _qrcode_executor.submit(
+                create_qrcode,
+                code,
+                image_format,
+                box_size,
+            )
+        except BrokenProcessPool:
+            pass
+    future = Future()
+    future.set_result(create_qrcode(code, image_format, box_size))
+    return future
@@ -0,0 +1,53 @@
+import argparse
+import itertools
+import time
+
+from dotenv import load_dotenv
+
+import db_processing
+
+
+def create_synthetic_bookings(bookings_count):
+    storage_ids = itertools.cycle(db_processing.get_storages())
+    item_ids = itertools.cycle(db_processing.get_prices_by_category('season'))
+    client_bookings = {}
+    for booking_number in range(bookings_count):
+        client_bookings[str(booking_number)] = {
+            'storage_id': next(storage_ids),
+            'category': booking_number % 2 and 'other' or 'season',
+            'item_id': next(item_ids),
+            'count': 1,
+            'start_date': '2022-01-01',
+            'end_date': '2022-02-01',
+        }
+    return client_bookings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Время построения списка бронирований клиента'
+    )
+    parser.add_argument(
+        '--bookings',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000, 10000],
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    load_dotenv()
+    for bookings_count in args.bookings:
+        client_bookings = create_synthetic_bookings(bookings_count)
+        started_at = time.perf_counter()
+        for _ in range(args.repeat):
+            db_processing.create_bookings_message(client_bookings)
+        elapsed = (time.perf_counter() - started_at) / args.repeat
+        print(
+            f'Бронирований: {bookings_count}, {elapsed * 1000:.2f} мс, '
+            f'{elapsed / bookings_count * 1e6:.2f} мкс на бронирование'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Condition, Lock, Semaphore
+
+from telegram.ext import Dispatcher, JobQueue, Updater
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Dispatcher that runs handlers on a thread pool.
+
+    Updates of different chats are processed concurrently, updates of the
+    same chat are processed strictly one after another in arrival order.
+    At most ``queue_size`` updates wait for processing, after that the
+    dispatcher thread stops taking new updates from the update queue.
+    ``on_processed`` passed to ``process_update`` is called from the pool
+    once the update has been handled.
+    """
+
+    def __init__(self, *args, pool_size=8, queue_size=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix='chat_worker',
+        )
+        self._free_slots = Semaphore(queue_size)
+        self._chat_updates = {}
+        self._chat_updates_lock = Lock()
+        self._chat_updates_drained = Condition(self._chat_updates_lock)
+
+    def process_update(self, update, on_processed=None):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            super().process_update(update)
+            if on_processed is not None:
+                on_processed()
+            return
+
+        self._free_slots.acquire()
+        with self._chat_updates_lock:
+            pending_updates = self._chat_updates.get(chat.id)
+            if pending_updates is not None:
+                pending_updates.append((update, on_processed))
+                return
+            self._chat_updates[chat.id] = deque()
+        self._executor.submit(
+            self._process_chat_update,
+            chat.id,
+            update,
+            on_processed,
+        )
+
+    def _process_chat_update(self, chat_id, update, on_processed):
+        try:
+            super().process_update(update)
+            if on_processed is not None:
+                on_processed()
+        except Exception:
+            logger.exception(f'Failed to process update for chat {chat_id}')
+        finally:
+            self._free_slots.release()
+
+        with self._chat_updates_lock:
+            pending_updates = self._chat_updates[chat_id]
+            if not pending_updates:
+                del self._chat_updates[chat_id]
+                if not self._chat_updates:
+                    self._chat_updates_drained.notify_all()
+                return
+            next_update, next_on_processed = pending_updates.popleft()
+        self._executor.submit(
+            self._process_chat_update,
+            chat_id,
+            next_update,
+            next_on_processed,
+        )
+
+    def stop(self):
+        super().stop()
+        # Pool threads submit queued updates of their chats themselves,
+        # so the executor is shut down only after every chat is drained.
+        with self._chat_updates_drained:
+            self._chat_updates_drained.wait_for(lambda: not self._chat_updates)
+        self._executor.shutdown(wait=True)
+
+
+def create_chat_ordered_updater(bot, pool_size, queue_size,
+                                persistence=None):
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(),
+        workers=1,
+        job_queue=job_queue,
+        persistence=persistence,
+        pool_size=pool_size,
+        queue_size=queue_size,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
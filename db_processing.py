@@ -1,14 +1,149 @@
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import date, timedelta
 from textwrap import dedent
 
 from dateutil.relativedelta import relativedelta
-from redis.exceptions import ResponseError
+from redis.exceptions import ResponseError, WatchError
 from rejson import Client, Path
 
 logger = logging.getLogger(__name__)
 _database = None
+_reserve_free_cells_script = None
+_hold_free_cells_script = None
+_reserve_promo_code_script = None
+_pop_due_items_script = None
+_join_waitlist_script = None
+_pop_waiters_script = None
+_catalog = {}
+_catalog_version = None
+_catalog_checked_at = 0
+_draft_sessions = threading.local()
+
+BOOKING_CONVERSATION = 'booking'
+MAX_PERIOD = {'season': 6, 'other': 12}
+MAX_WEEKS = 26
+MAX_COUNT = 10
+# Поля черновика, которые не сохраняются в бронировании.
+DRAFT_ONLY_FIELDS = ('is_held', 'promo_code_name')
+
+# Общая часть скриптов брони и удержания мест. Удаляет просроченные
+# удержания, затем проверяет, что с учётом занятости и чужих удержаний
+# мест хватает во все дни: ARGV[6] и далее.
+CHECK_FREE_CELLS_SCRIPT = """
+local now = tonumber(ARGV[4])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+if #expired > 0 then
+    redis.call('ZREM', KEYS[3], unpack(expired))
+    redis.call('HDEL', KEYS[4], unpack(expired))
+end
+local ok, capacity = pcall(redis.call, 'JSON.GET', KEYS[1], ARGV[1])
+if not ok or not capacity then
+    return -1
+end
+capacity = tonumber(capacity)
+local count = tonumber(ARGV[2])
+local occupied = redis.call('HMGET', KEYS[2], unpack(ARGV, 6))
+local holds = redis.call('HGETALL', KEYS[4])
+for i = 1, #holds, 2 do
+    if holds[i] ~= ARGV[3] then
+        local hold_count, hold_start, hold_end = string.match(
+            holds[i + 1], '(%d+) (%S+) (%S+)'
+        )
+        for day = 1, #occupied do
+            local booking_day = ARGV[day + 5]
+            if hold_start <= booking_day and booking_day <= hold_end then
+                occupied[day] = (tonumber(occupied[day]) or 0)
+                    + tonumber(hold_count)
+            end
+        end
+    end
+end
+local min_free = capacity
+for day = 1, #occupied do
+    local free = capacity - (tonumber(occupied[day]) or 0)
+    if free < count then
+        return -1
+    end
+    min_free = math.min(min_free, free)
+end
+"""
+
+HOLD_FREE_CELLS_SCRIPT = CHECK_FREE_CELLS_SCRIPT + """
+redis.call('ZADD', KEYS[3], ARGV[5], ARGV[3])
+redis.call('HSET', KEYS[4], ARGV[3], ARGV[2] .. ' ' .. ARGV[6] .. ' ' .. ARGV[#ARGV])
+return min_free - count
+"""
+
+RESERVE_FREE_CELLS_SCRIPT = CHECK_FREE_CELLS_SCRIPT + """
+for i = 6, #ARGV do
+    redis.call('HINCRBY', KEYS[2], ARGV[i], count)
+end
+redis.call('ZREM', KEYS[3], ARGV[3])
+redis.call('HDEL', KEYS[4], ARGV[3])
+return min_free - count
+"""
+
+POP_DUE_ITEMS_SCRIPT = """
+local items = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2]
+)
+if #items > 0 then
+    redis.call('ZREM', KEYS[1], unpack(items))
+end
+return items
+"""
+
+# Резерв промокода: оплаченные использования и живые резервы вместе
+# не должны превышать лимиты. Просроченные резервы удаляются.
+RESERVE_PROMO_CODE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', ARGV[5])
+if redis.call('ZSCORE', KEYS[3], ARGV[2]) then
+    redis.call('ZADD', KEYS[3], ARGV[6], ARGV[2])
+    return 1
+end
+local usage_limit = tonumber(ARGV[3])
+local client_limit = tonumber(ARGV[4])
+local used = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+    + redis.call('ZCARD', KEYS[3])
+if usage_limit > 0 and used >= usage_limit then
+    return 0
+end
+local client_used = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or 0)
+if client_limit > 0 and client_used >= client_limit then
+    return 0
+end
+redis.call('ZADD', KEYS[3], ARGV[6], ARGV[2])
+return 1
+"""
+
+# Лист ожидания: список задаёт очередь, множество — кто в ней стоит.
+# Оба ключа меняются вместе, чтобы они не расходились.
+JOIN_WAITLIST_SCRIPT = """
+if redis.call('SADD', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+POP_WAITERS_SCRIPT = """
+local waiters = {}
+for _ = 1, tonumber(ARGV[1]) do
+    local waiter = redis.call('LPOP', KEYS[1])
+    if not waiter then
+        break
+    end
+    waiters[#waiters + 1] = waiter
+end
+if #waiters > 0 then
+    redis.call('SREM', KEYS[2], unpack(waiters))
+end
+return waiters
+"""
 
 
 def get_database_connection():
@@ -27,37 +162,283 @@ def get_database_connection():
     return _database
 
 
-def get_storages():
+def get_session_ttl():
+    """Время жизни черновиков и диалога без активности клиента, в секундах."""
+    return int(os.getenv('SESSION_TTL', default=3600))
+
+
+def get_hold_ttl():
+    """Сколько секунд места удерживаются за клиентом без его активности."""
+    return int(os.getenv('HOLD_TTL', default=900))
+
+
+def get_unpaid_booking_ttl():
+    """Через сколько секунд удаляется неоплаченное бронирование.
+
+    Должно быть больше SESSION_TTL, чтобы не удалить бронирование,
+    которое клиент ещё может оплатить.
+    """
+    return int(os.getenv('UNPAID_BOOKING_TTL', default=24 * 60 * 60))
+
+
+def get_conversation_key(name, key):
+    """Ключ с шагом диалога name для чата key = (chat_id, user_id)."""
+    return f'conversation_{name}_{"_".join(map(str, key))}'
+
+
+def get_conversation_index_key(name):
+    """Множество ключей get_conversation_key всех диалогов name."""
+    return f'conversations_{name}'
+
+
+class DraftSession:
+    """Черновики бронирования и клиента в рамках обработки одного апдейта.
+
+    Оба черновика загружаются одним запросом при первом обращении,
+    изменения копятся в памяти и записываются одним пайплайном в flush(),
+    который заодно продлевает время жизни черновиков и шага диалога.
+    """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self._documents = None
+        self._changed_keys = set()
+
+    def get(self, key):
+        if self._documents is None:
+            db = get_database_connection()
+            keys = [f'b{self.client_id}', f'c{self.client_id}']
+            self._documents = dict(
+                zip(keys, db.jsonmget(Path.rootPath(), *keys))
+            )
+        return self._documents[key]
+
+    def set(self, key, value):
+        self.get(key)
+        self._documents[key] = value
+        self._changed_keys.add(key)
+
+    def flush(self):
+        session_ttl = get_session_ttl()
+        db = get_database_connection()
+        pipe = db.pipeline(transaction=False)
+        for key in (f'b{self.client_id}', f'c{self.client_id}'):
+            if key not in self._changed_keys:
+                pipe.expire(key, session_ttl)
+            elif self._documents[key] is None:
+                pipe.delete(key)
+            else:
+                pipe.jsonset(key, Path.rootPath(), self._documents[key])
+                pipe.expire(key, session_ttl)
+        pipe.expire(
+            get_conversation_key(
+                BOOKING_CONVERSATION,
+                (self.client_id, self.client_id),
+            ),
+            session_ttl,
+        )
+
+        booking = self._documents and self._documents[f'b{self.client_id}']
+        if booking and booking.get('is_held'):
+            holds_key, _ = get_holds_keys(
+                booking['storage_id'],
+                booking['category'],
+                booking['item_id'],
+            )
+            pipe.zadd(
+                holds_key,
+                {self.client_id: time.time() + get_hold_ttl()},
+                xx=True,
+            )
+        if booking and booking.get('promo_code_name'):
+            _, _, reservations_key = get_promo_code_keys(
+                booking['promo_code_name']
+            )
+            pipe.zadd(
+                reservations_key,
+                {self.client_id: time.time() + session_ttl},
+                xx=True,
+            )
+        pipe.execute()
+        self._changed_keys.clear()
+
+
+@contextmanager
+def draft_session(client_id):
+    active_session = getattr(_draft_sessions, 'session', None)
+    if active_session and active_session.client_id == client_id:
+        yield active_session
+        return
+
+    session = DraftSession(client_id)
+    _draft_sessions.session = session
+    try:
+        yield session
+        session.flush()
+    finally:
+        _draft_sessions.session = active_session
+
+
+def get_draft_document(client_id, key):
+    session = getattr(_draft_sessions, 'session', None)
+    if session and session.client_id == client_id:
+        return session.get(key)
     db = get_database_connection()
-    return db.jsonget('storages', Path.rootPath())
+    return db.jsonget(key, Path.rootPath())
+
+
+def set_draft_document(client_id, key, document):
+    session = getattr(_draft_sessions, 'session', None)
+    if session and session.client_id == client_id:
+        session.set(key, document)
+        return
+    db = get_database_connection()
+    if document is None:
+        db.delete(key)
+        return
+    pipe = db.pipeline(transaction=False)
+    pipe.jsonset(key, Path.rootPath(), document)
+    pipe.expire(key, get_session_ttl())
+    pipe.execute()
+
+
+def get_catalog_cache():
+    """Возвращает кэш справочников процесса.
+
+    Кэш сбрасывается, когда меняется ключ catalog_version. Версия
+    проверяется не чаще, чем раз в CATALOG_CHECK_INTERVAL секунд.
+    """
+    global _catalog, _catalog_version, _catalog_checked_at
+    db = get_database_connection()
+    check_interval = float(os.getenv('CATALOG_CHECK_INTERVAL', default=5))
+    now = time.monotonic()
+    if now - _catalog_checked_at >= check_interval:
+        version = db.get('catalog_version')
+        _catalog_checked_at = now
+        if version != _catalog_version:
+            _catalog = {}
+            _catalog_version = version
+    return _catalog
+
+
+def get_catalog_document(name):
+    """Возвращает справочник (склады, цены) из кэша процесса."""
+    catalog = get_catalog_cache()
+    if name not in catalog:
+        db = get_database_connection()
+        catalog[name] = db.jsonget(name, Path.rootPath())
+    return catalog[name]
+
+
+def bump_catalog_version():
+    db = get_database_connection()
+    version = db.incr('catalog_version')
+    logger.info(f'Catalog version changed to {version}')
+    return version
+
+
+def get_storages():
+    return get_catalog_document('storages')
 
 
 def get_prices_by_category(category):
+    return get_catalog_document('prices')[category]
+
+
+def get_promo_code(promo_code, check_date=None):
+    """Возвращает условия промокода, если он действует в указанный день."""
+    promo_codes = get_catalog_document('promo_codes') or {}
+    terms = promo_codes.get(promo_code)
+    if terms is None:
+        return None
+    check_date = (check_date or date.today()).isoformat()
+    if not terms['start_date'] <= check_date <= terms['end_date']:
+        return None
+    return terms
+
+
+def get_promo_code_keys(promo_code):
+    """Ключи счётчиков промокода: оплаченные использования всего
+    и по клиентам, резервы клиентов со временем их окончания."""
+    return (
+        'promo_codes_used',
+        f'promo_code_clients_{promo_code}',
+        f'promo_code_reservations_{promo_code}',
+    )
+
+
+def reserve_promo_code(promo_code, client_id):
+    """Атомарно резервирует использование промокода за клиентом.
+
+    Возвращает размер скидки в процентах или None, если промокод
+    не действует или исчерпан лимит использований (общий либо клиента).
+    Резерв живёт, пока жив черновик бронирования, и засчитывается
+    в использования только при оплате.
+    """
+    global _reserve_promo_code_script
+    terms = get_promo_code(promo_code)
+    if terms is None:
+        return None
+
     db = get_database_connection()
-    return db.jsonget('prices', Path(f'.{category}'))
+    if _reserve_promo_code_script is None:
+        _reserve_promo_code_script = db.register_script(
+            RESERVE_PROMO_CODE_SCRIPT
+        )
+    now = time.time()
+    is_reserved = _reserve_promo_code_script(
+        keys=get_promo_code_keys(promo_code),
+        args=[
+            promo_code,
+            client_id,
+            terms.get('usage_limit') or 0,
+            terms.get('client_limit') or 0,
+            now,
+            now + get_session_ttl(),
+        ],
+    )
+    if not is_reserved:
+        logger.info(f'Promo code {promo_code} limit reached for {client_id}')
+        return None
+    return terms['discount']
 
 
-def get_bookings_max_id():
+def commit_promo_code(client_id, booking):
+    """Засчитывает зарезервированный промокод оплаченного бронирования."""
+    promo_code = booking.get('promo_code_name')
+    if not promo_code:
+        return
+    used_key, clients_key, reservations_key = get_promo_code_keys(promo_code)
     db = get_database_connection()
-    ids = [int(booking_id) for booking_id in
-           db.jsonobjkeys('bookings', Path.rootPath())]
-    return max(ids)
+    pipe = db.pipeline()
+    pipe.zrem(reservations_key, client_id)
+    pipe.hincrby(used_key, promo_code, 1)
+    pipe.hincrby(clients_key, client_id, 1)
+    pipe.execute()
+
+
+def release_promo_code(client_id, booking):
+    if not booking or not booking.get('promo_code_name'):
+        return
+    _, _, reservations_key = get_promo_code_keys(booking['promo_code_name'])
+    db = get_database_connection()
+    db.zrem(reservations_key, client_id)
+
+
+def get_new_booking_id():
+    db = get_database_connection()
+    return db.incr('bookings_max_id')
 
 
 def is_week_price_available(booking):
     if booking["category"] == 'other':
         return False
-    db = get_database_connection()
-    chosen_stuff = db.jsonget('prices', Path(f'.season.{booking["item_id"]}'))
+    chosen_stuff = get_prices_by_category('season')[booking['item_id']]
     return chosen_stuff['price']['week']
 
 
 def calculate_total_cost(booking):
-    db = get_database_connection()
-    stuff = db.jsonget(
-        'prices',
-        Path(f'.{booking["category"]}.{booking["item_id"]}')
-    )
+    stuff = get_prices_by_category(booking['category'])[booking['item_id']]
     logger.info(f'Calculate total_cost for {stuff}')
 
     if booking['category'] == 'other':
@@ -71,6 +452,67 @@ def calculate_total_cost(booking):
     return price * booking['period_length'] * booking['count']
 
 
+def get_max_period(category, period_type):
+    if period_type == 'week':
+        return MAX_WEEKS
+    return MAX_PERIOD[category]
+
+
+def create_price_quotes(category):
+    """Считает стоимость для всех позиций категории, периодов и количеств.
+
+    Возвращает словарь quotes[item_id][period_type][period_length][count].
+    """
+    quotes = {}
+    counts = range(1, MAX_COUNT + 1)
+    for item_id, stuff in get_prices_by_category(category).items():
+        if category == 'other':
+            prices = {
+                'month': [
+                    stuff['base_price'] + stuff['add_one_price'] * (count - 1)
+                    for count in counts
+                ],
+            }
+        else:
+            prices = {
+                period_type: [price * count for count in counts]
+                for period_type, price in stuff['price'].items()
+                if price
+            }
+        quotes[item_id] = {
+            period_type: {
+                period_length: {
+                    count: price * period_length
+                    for count, price in zip(counts, count_prices)
+                }
+                for period_length in range(
+                    1,
+                    get_max_period(category, period_type) + 1,
+                )
+            }
+            for period_type, count_prices in prices.items()
+        }
+    return quotes
+
+
+def get_price_quotes(category):
+    """Возвращает сетку цен категории, пересчитывая её после смены цен."""
+    catalog = get_catalog_cache()
+    cache_key = f'price_quotes_{category}'
+    if cache_key not in catalog:
+        catalog[cache_key] = create_price_quotes(category)
+    return catalog[cache_key]
+
+
+def get_total_cost(booking):
+    quotes = get_price_quotes(booking['category'])
+    try:
+        return (quotes[booking['item_id']][booking['period_type']]
+                [booking['period_length']][booking['count']])
+    except KeyError:
+        return calculate_total_cost(booking)
+
+
 def get_end_date(start_date_iso, unit, period, correct_day=False):
     start_date = date.fromisoformat(start_date_iso)
 
@@ -84,8 +526,19 @@ def get_end_date(start_date_iso, unit, period, correct_day=False):
 
 def add_booking(booking):
     db = get_database_connection()
-    booking_id = get_bookings_max_id() + 1
-    db.jsonset('bookings', Path(f'.{booking_id}'), booking)
+    booking_id = get_new_booking_id()
+    booking = {
+        field: value for field, value in booking.items()
+        if field not in DRAFT_ONLY_FIELDS
+    }
+    pipe = db.pipeline()
+    pipe.jsonset(f'booking_{booking_id}', Path.rootPath(), booking)
+    pipe.zadd(
+        f'client_bookings_{booking["client_id"]}',
+        {booking_id: booking_id}
+    )
+    pipe.zadd('unpaid_bookings', {booking_id: time.time()})
+    pipe.execute()
     logger.info(f'Set booking {booking_id} to db: {booking}')
     return booking_id
 
@@ -117,13 +570,8 @@ def create_booking_message(booking):
         Для бронирования нажмите кнопку "Забронировать"
         '''
 
-    db = get_database_connection()
-
-    storage = db.jsonget('storages', Path(f'.{booking["storage_id"]}'))
-    stuff = db.jsonget(
-        'prices',
-        Path(f'.{booking["category"]}.{booking["item_id"]}')
-    )
+    storage = get_storages()[booking['storage_id']]
+    stuff = get_prices_by_category(booking['category'])[booking['item_id']]
 
     if booking['category'] == 'other':
         count_name = 'Площадь ячейки для хранения, кв.м.'
@@ -154,30 +602,196 @@ def create_booking_message(booking):
 
 def get_discounted_price(booking_id):   
     db = get_database_connection()
-    return db.jsonget('bookings', Path(f'.{booking_id}.discounted_price'))
+    return db.jsonget(f'booking_{booking_id}', Path('.discounted_price'))
 
 
-def get_passport(client_id):
+def set_booking_access_code(booking_id, access_code):
     db = get_database_connection()
-    passport_series_and_number = db.jsonget(
-        'clients',
-        Path(f'.{client_id}.passport')
+    pipe = db.pipeline()
+    pipe.jsonset(
+        f'booking_{booking_id}',
+        Path('.access_code'),
+        access_code
     )
-    return passport_series_and_number
+    pipe.hset('access_codes', access_code, booking_id)
+    pipe.execute()
 
 
-def set_booking_access_code(booking_id, access_code):
+def set_booking_qrcode_file_id(booking_id, file_id):
     db = get_database_connection()
-    db.jsonset(
-        'bookings',
-        Path(f'.{booking_id}.access_code'),
-        access_code
+    db.jsonset(f'booking_{booking_id}', Path('.qrcode_file_id'), file_id)
+
+
+def get_booking(booking_id):
+    db = get_database_connection()
+    return db.jsonget(f'booking_{booking_id}', Path.rootPath())
+
+
+def create_access_message(booking):
+    return (
+        f'Вот ваш электронный ключ для доступа к вашему личному складу. '
+        f'Вы сможете попасть на склад в любое время в период '
+        f'с {booking["start_date"]} по {booking["end_date"]}'
     )
 
 
+def get_pending_booking_id(client_id):
+    """Номер бронирования, которое клиент оформляет и ещё не оплатил."""
+    current_booking = get_client_current_booking(client_id)
+    if not current_booking or 'booking_id' not in current_booking:
+        return None
+    booking_id = current_booking['booking_id']
+    db = get_database_connection()
+    try:
+        status = db.jsonget(f'booking_{booking_id}', Path('.status'))
+    except ResponseError:
+        return None
+    if status != 'created':
+        return None
+    return booking_id
+
+
 def change_of_payment_status(booking_id):
     db = get_database_connection()
-    db.jsonset('bookings', Path(f'.{booking_id}.status'), 'payed')
+    pipe = db.pipeline()
+    pipe.jsonset(f'booking_{booking_id}', Path('.status'), 'payed')
+    pipe.zrem('unpaid_bookings', booking_id)
+    pipe.execute()
+
+
+def mark_booking_refund_required(booking_id):
+    """Оплаченный заказ без мест на складе: клиенту нужно вернуть деньги."""
+    db = get_database_connection()
+    pipe = db.pipeline()
+    pipe.jsonset(f'booking_{booking_id}', Path('.status'), 'refund_required')
+    pipe.zrem('unpaid_bookings', booking_id)
+    pipe.sadd('refund_required_bookings', booking_id)
+    pipe.execute()
+    logger.warning(f'Booking {booking_id} is payed but has no cells')
+
+
+def pop_due_items(key, max_score, count):
+    """Атомарно забирает из sorted set до count элементов со score <= max_score."""
+    global _pop_due_items_script
+    db = get_database_connection()
+    if _pop_due_items_script is None:
+        _pop_due_items_script = db.register_script(POP_DUE_ITEMS_SCRIPT)
+    return _pop_due_items_script(keys=[key], args=[max_score, count])
+
+
+def schedule_booking_expiry(booking_id, end_date):
+    db = get_database_connection()
+    db.zadd(
+        'bookings_by_end_date',
+        {booking_id: date.fromisoformat(end_date).toordinal()},
+    )
+
+
+def release_expired_bookings(batch_size=1000):
+    """Завершает бронирования, срок которых истёк до сегодняшнего дня.
+
+    Бронирования забираются из индекса bookings_by_end_date пачками,
+    получают статус finished, а прошедшие дни удаляются из хэша занятости.
+    Их коды доступа удаляются из индекса access_codes.
+    Возвращает число завершённых бронирований.
+    """
+    db = get_database_connection()
+    last_due_day = date.today().toordinal() - 1
+    released_count = 0
+    while True:
+        booking_ids = pop_due_items(
+            'bookings_by_end_date',
+            last_due_day,
+            batch_size,
+        )
+        if not booking_ids:
+            break
+
+        bookings = db.jsonmget(
+            Path.rootPath(),
+            *[f'booking_{booking_id}' for booking_id in booking_ids]
+        )
+        pipe = db.pipeline(transaction=False)
+        for booking_id, booking in zip(booking_ids, bookings):
+            if booking is None:
+                continue
+            pipe.jsonset(f'booking_{booking_id}', Path('.status'), 'finished')
+            if booking.get('access_code'):
+                pipe.hdel('access_codes', booking['access_code'])
+            pipe.hdel(
+                get_occupancy_key(
+                    booking['storage_id'],
+                    booking['category'],
+                    booking['item_id'],
+                ),
+                *get_booking_days(booking['start_date'], booking['end_date'])
+            )
+            pipe.sadd(
+                'waitlist_released',
+                get_released_item(
+                    booking['storage_id'],
+                    booking['category'],
+                    booking['item_id'],
+                ),
+            )
+        pipe.execute()
+        released_count += len(booking_ids)
+        if len(booking_ids) < batch_size:
+            break
+    return released_count
+
+
+def reap_unpaid_bookings(batch_size=1000):
+    """Удаляет бронирования, не оплаченные за get_unpaid_booking_ttl секунд.
+
+    Бронирования забираются из индекса unpaid_bookings пачками и удаляются
+    вместе с записями в client_bookings одной транзакцией на пачку.
+    Бронирования, оплаченные после попадания в пачку, не удаляются.
+    Возвращает число удалённых бронирований.
+    """
+    db = get_database_connection()
+    created_before = time.time() - get_unpaid_booking_ttl()
+    reaped_count = 0
+    while True:
+        booking_ids = pop_due_items(
+            'unpaid_bookings',
+            created_before,
+            batch_size,
+        )
+        if not booking_ids:
+            break
+
+        booking_keys = [f'booking_{booking_id}' for booking_id in booking_ids]
+        with db.pipeline() as pipe:
+            while True:
+                try:
+                    # оплата может сменить статус, пока пачка проверяется
+                    pipe.watch(*booking_keys)
+                    statuses = pipe.jsonmget(Path('.status'), *booking_keys)
+                    client_ids = pipe.jsonmget(
+                        Path('.client_id'),
+                        *booking_keys
+                    )
+                    pipe.multi()
+                    unpaid_count = 0
+                    for booking_id, status, client_id in zip(
+                        booking_ids,
+                        statuses,
+                        client_ids,
+                    ):
+                        if status != 'created':
+                            continue
+                        pipe.delete(f'booking_{booking_id}')
+                        pipe.zrem(f'client_bookings_{client_id}', booking_id)
+                        unpaid_count += 1
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        reaped_count += unpaid_count
+        if len(booking_ids) < batch_size:
+            break
+    return reaped_count
 
 
 def add_client_personal_data_to_database(client_id, client_data):
@@ -189,22 +803,21 @@ def add_client_personal_data_to_database(client_id, client_data):
 
 
 def clear_client_booking(client_id):
-    db = get_database_connection()
-    db.jsondel(f'b{client_id}', Path.rootPath())
+    current_booking = get_client_current_booking(client_id)
+    release_booking_hold(client_id, current_booking)
+    release_promo_code(client_id, current_booking)
+    set_draft_document(client_id, f'b{client_id}', None)
     logger.info(f'Clear {client_id} current booking')
 
 
 def get_client_current_booking(client_id):
-    db = get_database_connection()
-    current_booking = db.jsonget(f'b{client_id}', Path.rootPath())
-    return current_booking
+    return get_draft_document(client_id, f'b{client_id}')
 
 
 def set_client_current_booking(client_id, booking):
-    db = get_database_connection()
-    current_booking = db.jsonset(f'b{client_id}', Path.rootPath(), booking)
+    set_draft_document(client_id, f'b{client_id}', booking)
     logger.info(f'Update client {client_id} current booking to {booking}')
-    return current_booking
+    return booking
 
 
 def add_stuff_to_booking(client_id, button_text):
@@ -224,6 +837,8 @@ def add_count_to_booking(client_id, count):
 
 def create_new_booking(client_id, button_text):
     current_booking = get_client_current_booking(client_id)
+    release_booking_hold(client_id, current_booking)
+    release_promo_code(client_id, current_booking)
     storage_id, *_ = button_text.split('.')
     current_booking = {
         'storage_id': storage_id,
@@ -261,8 +876,10 @@ def add_period_length_to_booking(client_id, period_length, start_date=None):
 
 def add_booking_cost(client_id):
     current_booking = get_client_current_booking(client_id)
-    total_cost = calculate_total_cost(current_booking)
+    total_cost = get_total_cost(current_booking)
+    release_promo_code(client_id, current_booking)
     current_booking['promo_code'] = 0
+    current_booking.pop('promo_code_name', None)
     current_booking['total_cost'] = total_cost
     current_booking['discounted_price'] = total_cost
     set_client_current_booking(client_id, current_booking)
@@ -270,7 +887,6 @@ def add_booking_cost(client_id):
 
 
 def create_new_client(client_id):
-    db = get_database_connection()
     new_client = {
         'name': '',
         'surname': '',
@@ -279,7 +895,7 @@ def create_new_client(client_id):
         'birth_date': '',
         'phone': '',
     }
-    db.jsonset(f'c{client_id}', Path.rootPath(), new_client)
+    set_draft_document(client_id, f'c{client_id}', new_client)
     return new_client
 
 
@@ -291,63 +907,311 @@ def add_booking_id_to_current_booking(client_id, booking_id):
 
 
 def get_current_client(client_id):
-    db = get_database_connection()
-    current_client = db.jsonget(f'c{client_id}', Path.rootPath())
-    return current_client
+    return get_draft_document(client_id, f'c{client_id}')
 
 
 def update_current_client(client_id, key, new_value):
-    db = get_database_connection()
-    db.jsonset(f'c{client_id}', Path(f'.{key}'), new_value)
     client = get_current_client(client_id)
+    client[key] = new_value
+    set_draft_document(client_id, f'c{client_id}', client)
     logger.info(f'Update current client {client_id} personal data to {client}')
     return client
 
 
 def clear_current_client(client_id):
-    db = get_database_connection()
-    db.jsondel(f'c{client_id}', Path.rootPath())
+    set_draft_document(client_id, f'c{client_id}', None)
     logger.info(f'Clear {client_id} current personal data')
 
 
 def update_current_booking(booking_id, key, new_value):
-    db = get_database_connection()
-    db.jsonset(f'b{booking_id}', Path(f'.{key}'), new_value)
     booking = get_client_current_booking(booking_id)
+    booking[key] = new_value
+    set_client_current_booking(booking_id, booking)
     logger.info(f'Update current client {booking_id} personal data to {booking}')
     return booking
 
 
 def client_param_type(client_id):
-    db = get_database_connection()
-    current_client = db.jsonget(f'c{client_id}', Path.rootPath())
+    current_client = get_current_client(client_id)
     for param, value in current_client.items():
         if not value:
             return param
 
 
-def get_free_cells_count(storage_id, category, item_id):
-    db = get_database_connection()
+def get_occupancy_key(storage_id, category, item_id):
+    return f'occupancy_storage_{storage_id}_{category}_item_{item_id}'
+
+
+def get_booking_days(start_date_iso, end_date_iso):
+    """Возвращает все дни бронирования в формате ISO, включая последний."""
+    start_date = date.fromisoformat(start_date_iso)
+    end_date = date.fromisoformat(end_date_iso)
+    return [
+        (start_date + timedelta(days=day)).isoformat()
+        for day in range((end_date - start_date).days + 1)
+    ]
+
+
+def get_cells_capacity(storage_id, category, item_id):
+    """Число мест позиции на складе, доступных для бронирования на каждый день."""
+    free_cells = get_catalog_document('free_cells')
     try:
-        free_cells_count = db.jsonget(
+        return (free_cells[f'storage_{storage_id}'][category]
+                [f'item_{item_id}']['total'])
+    except KeyError:
+        return 0
+
+
+def get_holds_keys(storage_id, category, item_id):
+    """Ключи удержаний мест позиции.
+
+    В sorted set лежат клиенты со временем окончания удержания,
+    в хэше — удержанные места в виде "количество начало конец".
+    """
+    item_key = f'storage_{storage_id}_{category}_item_{item_id}'
+    return f'holds_{item_key}', f'hold_cells_{item_key}'
+
+
+def add_held_cells(occupied, days, holders, holds, client_id=None):
+    """Добавляет к занятости по дням места из удержаний holders.
+
+    Удержание клиента client_id не учитывается.
+    """
+    for holder in holders:
+        if holder == str(client_id) or holder not in holds:
+            continue
+        hold_count, hold_start, hold_end = holds[holder].split()
+        for day_number, day in enumerate(days):
+            if hold_start <= day <= hold_end:
+                occupied[day_number] += int(hold_count)
+    return occupied
+
+
+def get_free_cells_count(storage_id, category, item_id,
+                         start_date=None, end_date=None, client_id=None):
+    """Число мест, свободных во все дни с start_date по end_date.
+
+    По умолчанию считается на сегодня. Занятость хранится по дням
+    в хэше get_occupancy_key, поэтому нужен один HMGET на весь период.
+    Места, удерживаемые другими клиентами, считаются занятыми.
+    """
+    capacity = get_cells_capacity(storage_id, category, item_id)
+    start_date = start_date or date.today().isoformat()
+    end_date = end_date or start_date
+    days = get_booking_days(start_date, end_date)
+
+    db = get_database_connection()
+    holds_key, hold_cells_key = get_holds_keys(storage_id, category, item_id)
+    pipe = db.pipeline(transaction=False)
+    pipe.hmget(get_occupancy_key(storage_id, category, item_id), days)
+    pipe.zrangebyscore(holds_key, time.time(), '+inf')
+    pipe.hgetall(hold_cells_key)
+    occupied, holders, holds = pipe.execute()
+
+    occupied = [int(count or 0) for count in occupied]
+    add_held_cells(occupied, days, holders, holds, client_id)
+    return capacity - max(occupied)
+
+
+def get_storage_free_cells_counts(storage_id):
+    """Возвращает число свободных на сегодня мест по всем позициям склада.
+
+    Как и в get_free_cells_count, места, удерживаемые клиентами,
+    считаются занятыми.
+    """
+    free_cells = get_catalog_document('free_cells')
+    storage_cells = free_cells.get(f'storage_{storage_id}', {})
+    today = date.today().isoformat()
+    now = time.time()
+
+    db = get_database_connection()
+    pipe = db.pipeline(transaction=False)
+    items = []
+    for category, category_cells in storage_cells.items():
+        for item_key, cells in category_cells.items():
+            item_id = item_key.split('_')[1]
+            items.append((category, item_id, cells['total']))
+            holds_key, hold_cells_key = get_holds_keys(
+                storage_id, category, item_id
+            )
+            pipe.hget(get_occupancy_key(storage_id, category, item_id), today)
+            pipe.zrangebyscore(holds_key, now, '+inf')
+            pipe.hgetall(hold_cells_key)
+
+    results = pipe.execute()
+    free_cells_counts = {category: {} for category in storage_cells}
+    for item_number, (category, item_id, capacity) in enumerate(items):
+        occupied, holders, holds = results[3 * item_number:3 * item_number + 3]
+        occupied = add_held_cells(
+            [int(occupied or 0)], [today], holders, holds
+        )
+        free_cells_counts[category][item_id] = capacity - occupied[0]
+    return free_cells_counts
+
+
+def run_free_cells_script(script, client_id, storage_id, category, item_id,
+                          count, start_date, end_date):
+    holds_key, hold_cells_key = get_holds_keys(storage_id, category, item_id)
+    now = time.time()
+    return script(
+        keys=[
             'free_cells',
-            Path(f'.storage_{storage_id}.{category}.item_{item_id}.free'),
+            get_occupancy_key(storage_id, category, item_id),
+            holds_key,
+            hold_cells_key,
+        ],
+        args=[
+            f'.storage_{storage_id}.{category}.item_{item_id}.total',
+            count,
+            client_id,
+            now,
+            now + get_hold_ttl(),
+            *get_booking_days(start_date, end_date),
+        ],
+    )
+
+
+def hold_free_cells(client_id, storage_id, category, item_id, count,
+                    start_date=None, end_date=None):
+    """Атомарно удерживает места за клиентом на время оформления заказа.
+
+    Новое удержание клиента заменяет прежнее. Удержание продлевается на
+    HOLD_TTL при каждом сообщении клиента и пропадает само, если клиент
+    замолчал. По умолчанию места удерживаются на сегодня.
+    """
+    global _hold_free_cells_script
+    db = get_database_connection()
+    if _hold_free_cells_script is None:
+        _hold_free_cells_script = db.register_script(HOLD_FREE_CELLS_SCRIPT)
+    start_date = start_date or date.today().isoformat()
+    free_cells_left = run_free_cells_script(
+        _hold_free_cells_script,
+        client_id,
+        storage_id,
+        category,
+        item_id,
+        count,
+        start_date,
+        end_date or start_date,
+    )
+    return free_cells_left >= 0
+
+
+def release_booking_hold(client_id, booking):
+    if not booking or not booking.get('is_held'):
+        return
+    holds_key, hold_cells_key = get_holds_keys(
+        booking['storage_id'],
+        booking['category'],
+        booking['item_id'],
+    )
+    db = get_database_connection()
+    pipe = db.pipeline()
+    pipe.zrem(holds_key, client_id)
+    pipe.hdel(hold_cells_key, client_id)
+    pipe.sadd(
+        'waitlist_released',
+        get_released_item(
+            booking['storage_id'],
+            booking['category'],
+            booking['item_id'],
+        ),
+    )
+    pipe.execute()
+
+
+def reserve_free_cells(client_id, storage_id, category, item_id,
+                       count_reserved, start_date, end_date):
+    """Атомарно занимает места на каждый день бронирования.
+
+    Места занимаются, только если их хватает во все дни периода с учётом
+    чужих удержаний. Удержание самого клиента при этом снимается.
+    """
+    global _reserve_free_cells_script
+    db = get_database_connection()
+    if _reserve_free_cells_script is None:
+        _reserve_free_cells_script = db.register_script(
+            RESERVE_FREE_CELLS_SCRIPT
         )
-        return free_cells_count
-    except ResponseError:
-        return 0
+    free_cells_left = run_free_cells_script(
+        _reserve_free_cells_script,
+        client_id,
+        storage_id,
+        category,
+        item_id,
+        count_reserved,
+        start_date,
+        end_date,
+    )
+    if free_cells_left < 0:
+        logger.warning(
+            f'Not enough free cells in storage_{storage_id}.{category}.'
+            f'item_{item_id} to reserve {count_reserved} '
+            f'from {start_date} to {end_date}'
+        )
+        return False
+    return True
 
 
-def update_free_cells_count(storage_id, category, item_id, count_reserved):
-    previous_count = get_free_cells_count(storage_id, category, item_id)
-    db = get_database_connection()       
-    db.jsonset(
-        'free_cells',
-        Path(f'.storage_{storage_id}.{category}.item_{item_id}.free'),
-        previous_count - count_reserved,
+def get_waitlist_keys(storage_id, category, item_id):
+    """Ключи листа ожидания позиции: очередь клиентов и их множество."""
+    item_key = f'storage_{storage_id}_{category}_item_{item_id}'
+    return f'waitlist_{item_key}', f'waitlist_members_{item_key}'
+
+
+def get_released_item(storage_id, category, item_id):
+    return f'{storage_id}:{category}:{item_id}'
+
+
+def join_waitlist(client_id, storage_id, category, item_id):
+    """Ставит клиента в конец листа ожидания, если его там ещё нет."""
+    global _join_waitlist_script
+    db = get_database_connection()
+    if _join_waitlist_script is None:
+        _join_waitlist_script = db.register_script(JOIN_WAITLIST_SCRIPT)
+    is_joined = _join_waitlist_script(
+        keys=get_waitlist_keys(storage_id, category, item_id),
+        args=[client_id],
+    )
+    return bool(is_joined)
+
+
+def mark_cells_released(storage_id, category, item_id):
+    db = get_database_connection()
+    db.sadd(
+        'waitlist_released',
+        get_released_item(storage_id, category, item_id),
+    )
+
+
+def pop_released_items(count=100):
+    """Забирает позиции, у которых освобождались места."""
+    db = get_database_connection()
+    released_items = db.spop('waitlist_released', count) or []
+    return [tuple(item.split(':')) for item in released_items]
+
+
+def pop_waiters(storage_id, category, item_id, count):
+    """Забирает из начала листа ожидания до count клиентов."""
+    global _pop_waiters_script
+    db = get_database_connection()
+    if _pop_waiters_script is None:
+        _pop_waiters_script = db.register_script(POP_WAITERS_SCRIPT)
+    return _pop_waiters_script(
+        keys=get_waitlist_keys(storage_id, category, item_id),
+        args=[count],
     )
 
 
+def create_waitlist_message(storage_id, category, item_id):
+    storage = get_storages()[storage_id]
+    stuff = get_prices_by_category(category)[item_id]
+    return dedent(f'''\
+        На складе {storage['name']} ({storage['address']}) освободились места
+        для позиции "{stuff['name']}".
+        Чтобы забронировать, введите команду /start''')
+
+
 def is_client_exists(client_id):
     db = get_database_connection()
     try:
@@ -366,46 +1230,51 @@ def copy_client_to_current(client_id):
         'clients',
         Path(f'.{client_id}'),
     ) 
-    db.jsonset(
-        f'c{client_id}',
-        Path.rootPath(),
-        client
-    )
+    set_draft_document(client_id, f'c{client_id}', client)
     logger.info(f'Load client {client_id} data to current client to verify')
 
 
 def get_client_bookings(client_id):
     db = get_database_connection()
     if db.jsonget('clients', Path(f'.{client_id}')):
-        bookings = db.jsonget('bookings', Path.rootPath())
+        booking_ids = db.zrange(f'client_bookings_{client_id}', 0, -1)
+        if not booking_ids:
+            return dict()
+        bookings = db.jsonmget(
+            Path.rootPath(),
+            *[f'booking_{booking_id}' for booking_id in booking_ids]
+        )
         client_bookings = dict()
-        for booking_id, booking in bookings.items():
-            if booking['client_id'] == str(client_id):
+        for booking_id, booking in zip(booking_ids, bookings):
+            if booking:
                 client_bookings[booking_id] = booking
         return client_bookings
     return None
 
 
 def create_bookings_message(client_bookings):
-    db = get_database_connection()
-    prices = db.jsonget('prices', Path.rootPath())
-    message_text = 'Список ваших бронирований:'
+    season_prices = get_prices_by_category('season')
+    storages = get_storages()
+    messages = ['Список ваших бронирований:']
     for booking_id, booking in client_bookings.items():
-        storage = db.jsonget('storages', Path(f'.{booking["storage_id"]}'))
+        address = storages[booking['storage_id']]['address']
         if booking['category'] == 'other':
-            message = (
-                f'\n\nИдентификационный номер заказа: {booking_id}\nПо адресу'
-                f' {storage["address"]} с {booking["start_date"]} '
-                f'по {booking["end_date"]} хранятся '
-                f'ваши вещи на площади в {booking["count"]} кв.м.'
+            stored_stuff = (
+                f'хранятся ваши вещи на площади в {booking["count"]} кв.м.'
             )
-        if booking['category'] == 'season':
-            message = (
-                f'\n\nИдентификационный номер заказа: {booking_id}\nПо адресу'
-                f' {storage["address"]} с {booking["start_date"]} '
-                f'по {booking["end_date"]} хранится '
-                f'позиция "{prices["season"][booking["item_id"]]["name"]}" в'
+        else:
+            item_name = season_prices[booking['item_id']]['name']
+            stored_stuff = (
+                f'хранится позиция "{item_name}" в'
                 f' количестве {booking["count"]} штук(и).'
             )
-        message_text += message
-    return message_text
+        messages.append(
+            f'Идентификационный номер заказа: {booking_id}\nПо адресу'
+            f' {address} с {booking["start_date"]} '
+            f'по {booking["end_date"]} {stored_stuff}'
+        )
+    messages.append(
+        'Чтобы получить электронный ключ от ячейки повторно, '
+        'отправьте команду /key <номер заказа>'
+    )
+    return '\n\n'.join(messages)
@@ -0,0 +1,179 @@
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from dotenv import load_dotenv
+
+import access_qrcode as qr
+import db_processing
+
+SCANS_STREAM = 'gate_scans'
+SCANS_STREAM_MAX_LENGTH = 1000000
+ENTRIES_COUNTER_TTL = 2 * 24 * 60 * 60
+LOAD_TEST_KEY_PREFIX = 'load_test_'
+
+
+def get_entries_counter_key(storage_id, scanned_at, key_prefix=''):
+    return f'{key_prefix}storage_entries_{storage_id}_{scanned_at:%Y%m%d%H}'
+
+
+def check_access_codes(scans, key_prefix=''):
+    """Returns booking id for every scan that opens its storage, else None.
+
+    Every scan is a dict with access_code, storage_id and scanned_at
+    (datetime). Signatures and dates are checked offline, Redis is asked
+    once for the whole batch to make sure the codes were issued.
+    Keys are prefixed with key_prefix, the load test keeps its data apart.
+    """
+    if not scans:
+        return []
+    db = db_processing.get_database_connection()
+    issued_booking_ids = db.hmget(
+        f'{key_prefix}access_codes',
+        [scan['access_code'] for scan in scans],
+    )
+
+    booking_ids = []
+    for scan, issued_booking_id in zip(scans, issued_booking_ids):
+        access = qr.verify_access_code(
+            scan['access_code'],
+            scan['scanned_at'].date(),
+        )
+        if (access and access['storage_id'] == str(scan['storage_id'])
+                and access['booking_id'] == issued_booking_id):
+            booking_ids.append(issued_booking_id)
+        else:
+            booking_ids.append(None)
+    return booking_ids
+
+
+def check_access(access_code, storage_id):
+    scan = {
+        'access_code': access_code,
+        'storage_id': storage_id,
+        'scanned_at': datetime.now(),
+    }
+    booking_id, = check_access_codes([scan])
+    return booking_id
+
+
+def ingest_scans(scans, key_prefix=''):
+    """Checks a batch of gate scans and records them.
+
+    Scans are dicts as in check_access_codes plus gate_id. All of them are
+    appended to the gate_scans stream, granted ones also increment hourly
+    per-storage entry counters. Returns booking id (or None) of every scan.
+    """
+    booking_ids = check_access_codes(scans, key_prefix)
+    if not scans:
+        return booking_ids
+
+    db = db_processing.get_database_connection()
+    pipe = db.pipeline(transaction=False)
+    for scan, booking_id in zip(scans, booking_ids):
+        pipe.xadd(
+            f'{key_prefix}{SCANS_STREAM}',
+            {
+                'access_code': scan['access_code'],
+                'storage_id': scan['storage_id'],
+                'gate_id': scan['gate_id'],
+                'scanned_at': scan['scanned_at'].isoformat(),
+                'booking_id': booking_id or '',
+            },
+            maxlen=SCANS_STREAM_MAX_LENGTH,
+            approximate=True,
+        )
+        if booking_id:
+            counter_key = get_entries_counter_key(
+                scan['storage_id'],
+                scan['scanned_at'],
+                key_prefix,
+            )
+            pipe.incr(counter_key)
+            pipe.expire(counter_key, ENTRIES_COUNTER_TTL)
+    pipe.execute()
+    return booking_ids
+
+
+def get_storage_entries_count(storage_id, hours=24, key_prefix=''):
+    now = datetime.now()
+    counter_keys = [
+        get_entries_counter_key(
+            storage_id,
+            now - timedelta(hours=hour),
+            key_prefix,
+        )
+        for hour in range(hours)
+    ]
+    db = db_processing.get_database_connection()
+    return sum(int(count or 0) for count in db.mget(counter_keys))
+
+
+def create_synthetic_access_codes(codes_count, storages_count, key_prefix):
+    today = date.today()
+    db = db_processing.get_database_connection()
+    pipe = db.pipeline(transaction=False)
+    access_codes = []
+    for booking_number in range(codes_count):
+        booking_id = f'load{booking_number}'
+        storage_id = str(booking_number % storages_count + 1)
+        access_code = qr.create_access_code(
+            booking_id,
+            storage_id,
+            (today - timedelta(days=1)).isoformat(),
+            (today + timedelta(days=1)).isoformat(),
+        )
+        pipe.hset(f'{key_prefix}access_codes', access_code, booking_id)
+        access_codes.append((access_code, storage_id))
+    pipe.execute()
+    return access_codes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест приёма сканирований на воротах складов'
+    )
+    parser.add_argument('--scans', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--codes', type=int, default=1000)
+    parser.add_argument('--storages', type=int, default=4)
+    args = parser.parse_args()
+
+    load_dotenv()
+    access_codes = create_synthetic_access_codes(
+        args.codes,
+        args.storages,
+        LOAD_TEST_KEY_PREFIX,
+    )
+
+    granted_count = 0
+    started_at = time.monotonic()
+    for batch_start in range(0, args.scans, args.batch):
+        scans = []
+        for _ in range(min(args.batch, args.scans - batch_start)):
+            access_code, storage_id = random.choice(access_codes)
+            scans.append({
+                'access_code': access_code,
+                'storage_id': storage_id,
+                'gate_id': '1',
+                'scanned_at': datetime.now(),
+            })
+        granted_count += sum(
+            map(bool, ingest_scans(scans, LOAD_TEST_KEY_PREFIX))
+        )
+    elapsed = time.monotonic() - started_at
+
+    db = db_processing.get_database_connection()
+    db.delete(
+        f'{LOAD_TEST_KEY_PREFIX}access_codes',
+        f'{LOAD_TEST_KEY_PREFIX}{SCANS_STREAM}',
+        *db.scan_iter(f'{LOAD_TEST_KEY_PREFIX}storage_entries_*'),
+    )
+
+    print(f'Сканирований: {args.scans}, пропущено: {granted_count}')
+    print(f'Скорость: {args.scans / elapsed:.0f} сканирований в секунду')
+
+
+if __name__ == '__main__':
+    main()
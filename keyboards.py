@@ -39,6 +39,9 @@ def create_categories_keyboard():
 
 def create_other_keyboard(storage_id):
     category_stuffs = db_processing.get_prices_by_category('other')
+    free_cells_counts = db_processing.get_storage_free_cells_counts(
+        storage_id
+    ).get('other', {})
 
     keyboard = []
     text_template = '''\
@@ -47,11 +50,7 @@ def create_other_keyboard(storage_id):
         Мест на складе: {free_cells_count} кв.м.
         '''
     for stuff_id, stuff in category_stuffs.items():
-        free_cells_count = db_processing.get_free_cells_count(
-            storage_id,
-            'other',
-            stuff_id
-        )
+        free_cells_count = free_cells_counts.get(stuff_id, 0)
         button_caption = text_template.format(
             id=stuff_id,
             name=stuff['name'],
@@ -68,6 +67,9 @@ def create_other_keyboard(storage_id):
 def create_season_keyboard(storage_id):
     category_stuffs = category_stuffs = db_processing.get_prices_by_category(
         'season')
+    free_cells_counts = db_processing.get_storage_free_cells_counts(
+        storage_id
+    ).get('season', {})
 
     keyboard = []
     week_template = '''\
@@ -81,11 +83,7 @@ def create_season_keyboard(storage_id):
         Мест на складе: {free_cells_count}
         '''
     for stuff_id, stuff in category_stuffs.items():
-        free_cells_count = db_processing.get_free_cells_count(
-            storage_id,
-            'season',
-            stuff_id
-        )
+        free_cells_count = free_cells_counts.get(stuff_id, 0)
         if stuff["price"]["week"]:
             button_caption = week_template.format(
                 id=stuff_id,
@@ -113,6 +111,14 @@ def create_other_storage_keyboard():
     return make_reply_markup(keyboard)
 
 
+def create_waitlist_keyboard():
+    keyboard = [
+        [KeyboardButton(text='Встать в лист ожидания')],
+        [KeyboardButton(text='Выбрать другой склад')],
+    ]
+    return make_reply_markup(keyboard)
+
+
 def create_period_keyboard():
     keyboard = [[
         KeyboardButton(text='Неделя'),
@@ -0,0 +1,95 @@
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+from rejson import Path
+
+import db_processing
+
+
+def split_bookings_document(db, bookings):
+    pipe = db.pipeline()
+    for booking_id, booking in bookings.items():
+        pipe.jsonset(f'booking_{booking_id}', Path.rootPath(), booking)
+        pipe.zadd(
+            f'client_bookings_{booking["client_id"]}',
+            {booking_id: int(booking_id)}
+        )
+        if booking.get('status') == 'created':
+            pipe.zadd('unpaid_bookings', {booking_id: time.time()})
+        elif booking.get('status') == 'payed':
+            pipe.zadd(
+                'bookings_by_end_date',
+                {booking_id: date.fromisoformat(booking['end_date']).toordinal()}
+            )
+    pipe.execute()
+
+    max_id = max((int(booking_id) for booking_id in bookings), default=0)
+    if max_id > int(db.get('bookings_max_id') or 0):
+        db.set('bookings_max_id', max_id)
+
+
+def rebuild_occupancy(db, batch_size=1000):
+    """Заново заполняет занятость мест по дням из оплаченных бронирований."""
+    today = date.today().isoformat()
+    db.delete('bookings_by_end_date', *db.scan_iter('occupancy_storage_*'))
+
+    keys = list(db.scan_iter('booking_*'))
+    bookings_count = 0
+    for batch_start in range(0, len(keys), batch_size):
+        batch_keys = keys[batch_start:batch_start + batch_size]
+        pipe = db.pipeline()
+        for key, booking in zip(
+            batch_keys,
+            db.jsonmget(Path.rootPath(), *batch_keys),
+        ):
+            if (not booking or booking.get('status') != 'payed'
+                    or booking['end_date'] < today):
+                continue
+            booking_id = key.split('_', 1)[1]
+            end_date = date.fromisoformat(booking['end_date'])
+            pipe.zadd('bookings_by_end_date', {booking_id: end_date.toordinal()})
+            occupancy_key = db_processing.get_occupancy_key(
+                booking['storage_id'],
+                booking['category'],
+                booking['item_id'],
+            )
+            booking_days = db_processing.get_booking_days(
+                max(booking['start_date'], today),
+                booking['end_date'],
+            )
+            for day in booking_days:
+                pipe.hincrby(occupancy_key, day, booking['count'])
+            bookings_count += 1
+        pipe.execute()
+    print(f'Занятость восстановлена по {bookings_count} бронированиям')
+
+
+def index_conversations(db):
+    """Заносит шаги диалогов прежней версии в множество их ключей."""
+    name = db_processing.BOOKING_CONVERSATION
+    keys = list(db.scan_iter(db_processing.get_conversation_key(name, ('*',))))
+    if keys:
+        db.sadd(db_processing.get_conversation_index_key(name), *keys)
+
+
+def migrate_bookings(db):
+    if not db.exists('bookings'):
+        print('Документ bookings не найден, миграция не требуется')
+        return
+    bookings = db.jsonget('bookings', Path.rootPath())
+    split_bookings_document(db, bookings)
+    db.jsondel('bookings', Path.rootPath())
+    print(f'Перенесено бронирований: {len(bookings)}')
+
+
+def main():
+    load_dotenv()
+    db = db_processing.get_database_connection()
+    migrate_bookings(db)
+    rebuild_occupancy(db)
+    index_conversations(db)
+
+
+if __name__ == '__main__':
+    main()
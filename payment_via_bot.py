@@ -87,8 +87,8 @@ def successful_payment_callback(update: Update, context: CallbackContext) -> Non
     db = get_database_connection()
     booking_id = _booking['booking_id']
 
-    db.jsonset('bookings', Path(f'.{booking_id}.status'), 'payed')
-    booking = db.jsonget('bookings', Path(f'.{booking_id}'))
+    db.jsonset(f'booking_{booking_id}', Path('.status'), 'payed')
+    booking = db.jsonget(f'booking_{booking_id}', Path.rootPath())
     pprint(booking)
 
 def create_button(update: Update, context: CallbackContext) -> None:
@@ -0,0 +1,44 @@
+import argparse
+import time
+
+import access_qrcode as qr
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Скорость отрисовки QR-кодов доступа'
+    )
+    parser.add_argument('--codes', type=int, default=1000)
+    parser.add_argument(
+        '--workers',
+        type=int,
+        nargs='+',
+        default=[0, 1, 2, 4],
+        help='число процессов, 0 — отрисовка в текущем потоке',
+    )
+    args = parser.parse_args()
+
+    codes = [
+        f'1.{booking_number}.1.20220101.20220201.AAAAAAAAAAAAAAAA'
+        for booking_number in range(args.codes)
+    ]
+    for workers_count in args.workers:
+        if workers_count:
+            qr.start_qrcode_workers(workers_count)
+        started_at = time.monotonic()
+        futures = [qr.render_qrcode(code) for code in codes]
+        for future in futures:
+            future.result()
+        elapsed = time.monotonic() - started_at
+        qr.stop_qrcode_workers()
+
+        codes_per_second = args.codes / elapsed
+        print(
+            f'Процессов: {workers_count}, '
+            f'{codes_per_second:.0f} кодов в секунду, '
+            f'{codes_per_second / max(workers_count, 1):.0f} на ядро'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import time
+
+from dotenv import load_dotenv
+from rejson import Path
+
+import db_processing
+
+
+def create_synthetic_unpaid_bookings(bookings_count, batch_size):
+    db = db_processing.get_database_connection()
+    created_at = time.time() - db_processing.get_unpaid_booking_ttl() - 1
+    booking = {
+        'client_id': 'load',
+        'storage_id': '1',
+        'category': 'season',
+        'item_id': '1',
+        'count': 1,
+        'status': 'created',
+    }
+    for batch_start in range(0, bookings_count, batch_size):
+        pipe = db.pipeline(transaction=False)
+        batch_end = min(batch_start + batch_size, bookings_count)
+        for booking_number in range(batch_start, batch_end):
+            booking_id = f'load{booking_number}'
+            pipe.jsonset(f'booking_{booking_id}', Path.rootPath(), booking)
+            pipe.zadd('client_bookings_load', {booking_id: booking_number})
+            pipe.zadd('unpaid_bookings', {booking_id: created_at})
+        pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест удаления неоплаченных бронирований'
+    )
+    parser.add_argument('--bookings', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+
+    load_dotenv()
+    create_synthetic_unpaid_bookings(args.bookings, args.batch)
+
+    started_at = time.monotonic()
+    reaped_count = db_processing.reap_unpaid_bookings(args.batch)
+    elapsed = time.monotonic() - started_at
+
+    print(f'Удалено бронирований: {reaped_count} за {elapsed:.2f} с')
+    print(f'Скорость: {reaped_count / elapsed:.0f} бронирований в секунду')
+
+
+if __name__ == '__main__':
+    main()
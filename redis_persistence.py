@@ -0,0 +1,94 @@
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+import db_processing
+
+
+class RedisPersistence(BasePersistence):
+    """Stores ConversationHandler states in Redis.
+
+    Every chat gets its own small key ``conversation_{name}_{chat}_{user}``
+    holding the state value, the key expires together with the draft
+    booking: ``DraftSession.flush`` refreshes both. A state that did not
+    change is not written again. Keys are listed in the set
+    ``conversations_{name}`` so startup does not scan the keyspace.
+
+    States are loaded once at startup, after that they live in the
+    memory of the process. Each chat has to be handled by one process,
+    several webhook replicas behind a load balancer are not supported.
+    """
+
+    def __init__(self, state_type):
+        super().__init__(
+            store_user_data=False,
+            store_chat_data=False,
+            store_bot_data=False,
+        )
+        self.state_type = state_type
+        self._written_states = {}
+
+    def get_conversations(self, name):
+        db = db_processing.get_database_connection()
+        index_key = db_processing.get_conversation_index_key(name)
+        prefix = db_processing.get_conversation_key(name, ())
+        keys = list(db.smembers(index_key))
+        conversations = {}
+        expired_keys = []
+        for key, state in zip(keys, db.mget(keys) if keys else []):
+            if state is None:
+                expired_keys.append(key)
+                continue
+            conversation_key = tuple(
+                int(part) for part in key[len(prefix):].split('_')
+            )
+            conversations[conversation_key] = self.state_type(int(state))
+        if expired_keys:
+            db.srem(index_key, *expired_keys)
+        return conversations
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            new_state, _ = new_state
+        db = db_processing.get_database_connection()
+        index_key = db_processing.get_conversation_index_key(name)
+        redis_key = db_processing.get_conversation_key(name, key)
+        pipe = db.pipeline(transaction=False)
+        if new_state is None:
+            self._written_states.pop(redis_key, None)
+            pipe.delete(redis_key)
+            pipe.srem(index_key, redis_key)
+            pipe.execute()
+            return
+
+        session_ttl = db_processing.get_session_ttl()
+        now = time.monotonic()
+        written_state, written_at = self._written_states.get(
+            redis_key,
+            (None, 0),
+        )
+        if written_state == new_state and now - written_at < session_ttl / 2:
+            return
+        pipe.set(redis_key, new_state.value, ex=session_ttl)
+        pipe.sadd(index_key, redis_key)
+        pipe.execute()
+        self._written_states[redis_key] = (new_state, now)
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,100 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+from rejson import Path
+
+import db_processing
+
+STORAGE_ID = 'load'
+CATEGORY = 'season'
+ITEM_ID = '1'
+
+
+def create_synthetic_item(db, capacity):
+    db.jsonset(
+        'free_cells',
+        Path(f'.storage_{STORAGE_ID}'),
+        {CATEGORY: {f'item_{ITEM_ID}': {'total': capacity}}},
+    )
+
+
+def remove_synthetic_item(db):
+    db.jsondel('free_cells', Path(f'.storage_{STORAGE_ID}'))
+    db.delete(
+        db_processing.get_occupancy_key(STORAGE_ID, CATEGORY, ITEM_ID),
+        *db_processing.get_holds_keys(STORAGE_ID, CATEGORY, ITEM_ID),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Проверка брони мест под конкурентной нагрузкой'
+    )
+    parser.add_argument('--capacity', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = db_processing.get_database_connection()
+    if not db.exists('free_cells'):
+        db.jsonset('free_cells', Path.rootPath(), {})
+    create_synthetic_item(db, args.capacity)
+
+    start_date = date.today().isoformat()
+    end_date = (date.today() + timedelta(days=args.days - 1)).isoformat()
+
+    def book(client_number):
+        client_id = f'load{client_number}'
+        is_held = db_processing.hold_free_cells(
+            client_id,
+            STORAGE_ID,
+            CATEGORY,
+            ITEM_ID,
+            args.count,
+            start_date,
+            end_date,
+        )
+        is_reserved = is_held and db_processing.reserve_free_cells(
+            client_id,
+            STORAGE_ID,
+            CATEGORY,
+            ITEM_ID,
+            args.count,
+            start_date,
+            end_date,
+        )
+        return is_held, is_reserved
+
+    try:
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            results = list(executor.map(book, range(args.clients)))
+        elapsed = time.monotonic() - started_at
+
+        held_count = sum(is_held for is_held, _ in results)
+        reserved_count = sum(bool(is_reserved) for _, is_reserved in results)
+        occupied = db.hvals(
+            db_processing.get_occupancy_key(STORAGE_ID, CATEGORY, ITEM_ID)
+        )
+        max_occupied = max((int(count) for count in occupied), default=0)
+    finally:
+        remove_synthetic_item(db)
+
+    print(f'Удержаний: {held_count}, броней: {reserved_count}')
+    print(f'Занято мест (максимум по дням): {max_occupied} из {args.capacity}')
+    print(f'Скорость: {args.clients / elapsed:.0f} клиентов в секунду')
+    expected_count = min(args.clients, args.capacity // args.count)
+    if max_occupied > args.capacity or reserved_count != expected_count:
+        print('ОШИБКА: число броней не совпадает с вместимостью')
+        raise SystemExit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
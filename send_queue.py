@@ -0,0 +1,209 @@
+import logging
+import math
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_CLEANUP_INTERVAL = 60
+# Upper estimate of a Telegram API request duration, seconds
+SEND_REQUEST_LATENCY = 0.5
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def get_delay(self, now):
+        """Returns seconds left until a token is available."""
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._updated_at) * self.rate,
+        )
+        self._updated_at = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._tokens -= 1
+
+    def is_full(self, now):
+        self.get_delay(now)
+        return self._tokens >= self.capacity
+
+
+class SendQueue:
+    """Delivers outgoing Telegram requests within the flood limits.
+
+    Requests are sent not faster than ``global_rate`` per second overall and
+    ``chat_rate`` per second for a chat. Requests of a chat are sent one at
+    a time in the order they were queued. On a 429 response the whole queue
+    pauses for the time Telegram asked for and the request is retried.
+    The limits apply to this process only.
+
+    Each request blocks a sender thread until Telegram answers, so by
+    default there are enough threads to keep ``global_rate`` with
+    ``SEND_REQUEST_LATENCY`` per request.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3,
+                 pool_size=None):
+        if pool_size is None:
+            pool_size = max(4, math.ceil(global_rate * SEND_REQUEST_LATENCY))
+        self.pool_size = pool_size
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._chat_requests = {}
+        self._chats_in_flight = set()
+        self._paused_until = 0
+        self._buckets_dropped_at = time.monotonic()
+        self._is_stopped = False
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix='sender',
+        )
+        self._scheduler = Thread(
+            target=self._schedule,
+            name='send_queue',
+            daemon=True,
+        )
+        self._scheduler.start()
+
+    def put(self, chat_id, send):
+        future = Future()
+        with self._condition:
+            self._chat_requests.setdefault(chat_id, deque()).append(
+                (send, future)
+            )
+            self._condition.notify()
+        return future
+
+    def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._chat_requests and time.monotonic() < deadline:
+                self._condition.wait(0.1)
+            self._is_stopped = True
+            self._condition.notify()
+        self._executor.shutdown(wait=True)
+
+    def _schedule(self):
+        with self._condition:
+            while not self._is_stopped:
+                delay = self._send_ready_requests()
+                self._condition.wait(delay)
+
+    def _send_ready_requests(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if now - self._buckets_dropped_at > BUCKETS_CLEANUP_INTERVAL:
+            self._drop_idle_chat_buckets(now)
+
+        next_delay = None
+        for chat_id in list(self._chat_requests):
+            if chat_id in self._chats_in_flight:
+                continue
+            global_delay = self._global_bucket.get_delay(now)
+            if global_delay:
+                return global_delay
+
+            chat_bucket = self._chat_buckets.get(chat_id)
+            if chat_bucket is None:
+                chat_bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets[chat_id] = chat_bucket
+            chat_delay = chat_bucket.get_delay(now)
+            if chat_delay:
+                next_delay = min(next_delay or chat_delay, chat_delay)
+                continue
+
+            self._global_bucket.consume()
+            chat_bucket.consume()
+            send, future = self._chat_requests[chat_id].popleft()
+            self._chats_in_flight.add(chat_id)
+            self._executor.submit(self._send, chat_id, send, future)
+        return next_delay
+
+    def _send(self, chat_id, send, future):
+        try:
+            result = send()
+        except RetryAfter as error:
+            logger.warning(f'Flood limit hit, retry in {error.retry_after}s')
+            with self._condition:
+                self._paused_until = max(
+                    self._paused_until,
+                    time.monotonic() + error.retry_after,
+                )
+                self._chat_requests.setdefault(chat_id, deque()).appendleft(
+                    (send, future)
+                )
+                self._release_chat(chat_id)
+            return
+        except Exception as error:
+            logger.exception(f'Failed to send request to chat {chat_id}')
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+        with self._condition:
+            self._release_chat(chat_id)
+
+    def _release_chat(self, chat_id):
+        self._chats_in_flight.discard(chat_id)
+        if not self._chat_requests.get(chat_id):
+            self._chat_requests.pop(chat_id, None)
+        self._condition.notify()
+
+    def _drop_idle_chat_buckets(self, now):
+        for chat_id, chat_bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._chat_requests and chat_bucket.is_full(now):
+                del self._chat_buckets[chat_id]
+        self._buckets_dropped_at = now
+
+
+class QueuedBot(ExtBot):
+    """Bot that sends messages, photos and invoices through a SendQueue.
+
+    These methods return a Future with the sent Message instead of the
+    Message itself, so handlers do not wait for delivery.
+    """
+
+    def __init__(self, *args, send_queue, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_queue = send_queue
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.send_queue.put(
+            chat_id,
+            lambda: super(QueuedBot, self).send_message(
+                chat_id, *args, **kwargs
+            ),
+        )
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.send_queue.put(
+            chat_id,
+            lambda: super(QueuedBot, self).send_photo(
+                chat_id, *args, **kwargs
+            ),
+        )
+
+    def send_invoice(self, chat_id, *args, **kwargs):
+        return self.send_queue.put(
+            chat_id,
+            lambda: super(QueuedBot, self).send_invoice(
+                chat_id, *args, **kwargs
+            ),
+        )
@@ -4,6 +4,8 @@ from pprint import pprint
 from dotenv import load_dotenv
 from rejson import Client, Path
 
+from migrate_bookings import rebuild_occupancy, split_bookings_document
+
 STORAGES = {
     '1': {
         'city': 'Москва',
@@ -67,30 +69,42 @@ PRICES = {
     }
 }
 
+PROMO_CODES = {
+    'storage2022': {
+        'discount': 20,
+        'start_date': '2022-03-01',
+        'end_date': '2022-03-31',
+        'usage_limit': 1000,
+        'client_limit': 1,
+    },
+    'storage15': {
+        'discount': 15,
+        'start_date': '2021-11-01',
+        'end_date': '2022-04-30',
+        'usage_limit': None,
+        'client_limit': 1,
+    },
+}
+
 FREE_CELLS = {
     'storage_1': {
         'season': {
             'item_1': {
                 'total': 20,
-                'free': 16,
             },
             'item_2': {
                 'total': 10,
-                'free': 9,
             },
             'item_3': {
                 'total': 15,
-                'free': 12,
             },
             'item_4': {
                 'total': 10,
-                'free': 10,
             },
         },
         'other': {
             'item_1': {
                 'total': 100,
-                'free': 92,
             },
         },
     },
@@ -98,21 +112,17 @@ FREE_CELLS = {
         'season': {
             'item_1': {
                 'total': 20,
-                'free': 16,
             },
             'item_3': {
                 'total': 15,
-                'free': 12,
             },
             'item_4': {
                 'total': 10,
-                'free': 10,
             },
         },
         'other': {
             'item_1': {
                 'total': 50,
-                'free': 50,
             },
         },
     },
@@ -120,25 +130,20 @@ FREE_CELLS = {
         'season': {
             'item_1': {
                 'total': 20,
-                'free': 16,
             },
             'item_2': {
                 'total': 10,
-                'free': 9,
             },
             'item_3': {
                 'total': 15,
-                'free': 12,
             },
             'item_4': {
                 'total': 5,
-                'free': 0,
             },
         },
         'other': {
             'item_1': {
                 'total': 100,
-                'free': 92,
             },
         },
     },
@@ -146,25 +151,20 @@ FREE_CELLS = {
         'season': {
             'item_1': {
                 'total': 20,
-                'free': 18,
             },
             'item_2': {
                 'total': 10,
-                'free': 7,
             },
             'item_3': {
                 'total': 18,
-                'free': 15,
             },
             'item_4': {
                 'total': 15,
-                'free': 7,
             },
         },
         'other': {
             'item_1': {
                 'total': 150,
-                'free': 89,
             },
         },
     },
@@ -245,7 +245,10 @@ def get_database_connection():
 
 
 def print_db_content(db):
-    bookings = db.jsonget('bookings', Path.rootPath())
+    bookings = {
+        key.split('_')[1]: db.jsonget(key, Path.rootPath())
+        for key in db.scan_iter('booking_*')
+    }
     print("\nБронирования")
     pprint(bookings)
     clients = db.jsonget('clients', Path.rootPath())
@@ -260,6 +263,9 @@ def print_db_content(db):
     pprint(prices['season'])
     print("--- Другое ---")    
     pprint(prices['other'])
+    promo_codes = db.jsonget('promo_codes', Path.rootPath())
+    print("\nПромокоды")
+    pprint(promo_codes)
     free_cells = db.jsonget('free_cells', Path.rootPath())
     print("\nСвободные ячейки для хранения")
     pprint(free_cells)   
@@ -269,8 +275,11 @@ def load_test_data_to_db(db, rewrite_bot_results=False):
     db.jsonset('storages', Path.rootPath(), STORAGES)    
     db.jsonset('prices', Path.rootPath(), PRICES)
     db.jsonset('free_cells', Path.rootPath(), FREE_CELLS)
+    db.jsonset('promo_codes', Path.rootPath(), PROMO_CODES)
+    db.incr('catalog_version')
     if rewrite_bot_results:
-        db.jsonset('bookings', Path.rootPath(), BOOKINGS)
+        split_bookings_document(db, BOOKINGS)
+        rebuild_occupancy(db)
         db.jsonset('clients', Path.rootPath(), CLIENTS)
 
 
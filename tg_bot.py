@@ -1,21 +1,27 @@
 import logging
 import os
 from enum import Enum
+from functools import wraps
 from textwrap import dedent
 
 from dotenv import load_dotenv
 from telegram import LabeledPrice
 from telegram.ext import (CommandHandler, ConversationHandler, Filters,
                           MessageHandler, PreCheckoutQueryHandler, Updater)
+from telegram.utils.request import Request
 
 import access_qrcode as qr
+import chat_dispatcher
 import check_input
 import db_processing
 import keyboards
+import update_stream
+import webhook
+from redis_persistence import RedisPersistence
+from send_queue import QueuedBot, SendQueue
 
 logger = logging.getLogger(__name__)
 
-MAX_PERIOD = {'season': 6, 'other': 12}
 BOT_PAYLOAD = 'StuffStorageBot'
 
 
@@ -41,6 +47,16 @@ class States(Enum):
     CHECK_PROMO_CODE = 19
 
 
+def with_draft_session(handler):
+    """Loads client drafts once per update and flushes them after handler."""
+    @wraps(handler)
+    def wrapper(update, context):
+        with db_processing.draft_session(update.effective_chat.id):
+            return handler(update, context)
+    return wrapper
+
+
+@with_draft_session
 def start(update, context):
     db_processing.clear_client_booking(update.message.chat_id)
     db_processing.clear_current_client(update.message.chat_id)
@@ -55,9 +71,10 @@ def start(update, context):
         reply_markup=keyboards.create_storages_keyboard()
     )
 
-    return States.CHOOSE_STORAGE
+    return ConversationHandler.END
 
 
+@with_draft_session
 def handle_client_bookings(update, context):
     client_id = update.message.chat_id
     client_bookings = db_processing.get_client_bookings(client_id)
@@ -70,16 +87,31 @@ def handle_client_bookings(update, context):
     return handle_cancel(update, context)
 
 
+@with_draft_session
+def handle_conversation_timeout(update, context):
+    client_id = update.effective_chat.id
+    db_processing.clear_client_booking(client_id)
+    db_processing.clear_current_client(client_id)
+    context.bot.send_message(
+        chat_id=client_id,
+        text=dedent('''\
+            Бронирование отменено из-за долгого отсутствия ответа.
+            Чтобы начать заново, введите команду /start'''),
+    )
+
+
 def echo(update, context):
     update.message.reply_text(update.message.text)
 
 
+@with_draft_session
 def handle_unknown(update, context):
     update.message.reply_text(
         text='Извините, но я вас не понял :(',
     )
 
 
+@with_draft_session
 def handle_cancel(update, context):
     db_processing.clear_client_booking(update.message.chat_id)
     db_processing.clear_current_client(update.message.chat_id)
@@ -91,9 +123,10 @@ def handle_cancel(update, context):
         ''',
         reply_markup=keyboards.create_storages_keyboard()
     )
-    return States.CHOOSE_STORAGE
+    return ConversationHandler.END
 
 
+@with_draft_session
 def handle_storage_choice(update, context):
     db_processing.create_new_booking(
         update.message.chat_id,
@@ -106,15 +139,17 @@ def handle_storage_choice(update, context):
     return States.CHOOSE_CATEGORY
 
 
+@with_draft_session
 def handle_other_storage(update, context):
     db_processing.clear_client_booking(update.message.chat_id)
     update.message.reply_text(
         'Выберите, какой склад вам подходит:',
         reply_markup=keyboards.create_storages_keyboard()
     )
-    return States.CHOOSE_STORAGE
+    return ConversationHandler.END
 
 
+@with_draft_session
 def handle_season_choice(update, context):
     db_processing.add_category_to_booking(
         update.message.chat_id,
@@ -132,6 +167,7 @@ def handle_season_choice(update, context):
     return States.CHOOSE_STUFF
 
 
+@with_draft_session
 def handle_other_choice(update, context):
     db_processing.add_category_to_booking(
         update.message.chat_id,
@@ -149,6 +185,7 @@ def handle_other_choice(update, context):
     return States.CHOOSE_STUFF
 
 
+@with_draft_session
 def handle_choose_stuff(update, context):
     current_booking = db_processing.add_stuff_to_booking(
         update.message.chat_id,
@@ -164,6 +201,7 @@ def handle_choose_stuff(update, context):
     return States.INPUT_COUNT
 
 
+@with_draft_session
 def handle_input_count(update, context):
     current_booking = db_processing.add_count_to_booking(
         update.message.chat_id,
@@ -174,12 +212,42 @@ def handle_input_count(update, context):
 
     input_count = int(update.message.text)
 
-    max_count = db_processing.get_free_cells_count(
+    if input_count < 1 or input_count > db_processing.MAX_COUNT:
+        if current_booking['category'] == 'other':
+            message_begin = ('В бронировании площадь ячейки может быть указана'
+                             ' от 1 до 10 кв.м.')
+        else:
+            message_begin = ('Доступное количество ячеек для вещей в одном '
+                             'бронировании - от 1 до 10 шт.')
+
+        update.message.reply_text(f'{message_begin} Введите еще раз')
+        return States.INPUT_COUNT
+
+    client_id = update.message.chat_id
+    is_held = db_processing.hold_free_cells(
+        client_id,
         current_booking['storage_id'],
         current_booking['category'],
         current_booking['item_id'],
+        input_count,
     )
-    if input_count > max_count:
+    if not is_held:
+        max_count = db_processing.get_free_cells_count(
+            current_booking['storage_id'],
+            current_booking['category'],
+            current_booking['item_id'],
+            client_id=client_id,
+        )
+        if max_count <= 0:
+            update.message.reply_text(
+                dedent('''\
+                    Свободных мест на складе не осталось.
+                    Встаньте в лист ожидания, и мы напишем, когда места
+                    освободятся, или выберите другой склад'''),
+                reply_markup=keyboards.create_waitlist_keyboard()
+            )
+            return States.INPUT_COUNT
+
         update.message.reply_text(
             dedent(f'''\
                 На складе осталось {max_count} {units}.
@@ -187,17 +255,7 @@ def handle_input_count(update, context):
             reply_markup=keyboards.create_other_storage_keyboard()
         )
         return States.INPUT_COUNT
-
-    if input_count < 1 or input_count > 10:
-        if current_booking['category'] == 'other':
-            message_begin = ('В бронировании площадь ячейки может быть указана'
-                             ' от 1 до 10 кв.м.')
-        else:
-            message_begin = ('Доступное количество ячеек для вещей в одном '
-                             'бронировании - от 1 до 10 шт.')
-
-        update.message.reply_text(f'{message_begin} Введите еще раз')
-        return States.INPUT_COUNT
+    db_processing.update_current_booking(client_id, 'is_held', True)
 
     is_week = db_processing.is_week_price_available(current_booking)
 
@@ -219,6 +277,26 @@ def handle_input_count(update, context):
     return States.INPUT_PERIOD_LENGTH
 
 
+@with_draft_session
+def handle_join_waitlist(update, context):
+    client_id = update.message.chat_id
+    current_booking = db_processing.get_client_current_booking(client_id)
+    is_joined = db_processing.join_waitlist(
+        client_id,
+        current_booking['storage_id'],
+        current_booking['category'],
+        current_booking['item_id'],
+    )
+    if is_joined:
+        message_text = ('Вы в листе ожидания. Мы напишем, как только '
+                        'места освободятся.')
+    else:
+        message_text = 'Вы уже стоите в листе ожидания этой позиции.'
+    update.message.reply_text(message_text)
+    return handle_cancel(update, context)
+
+
+@with_draft_session
 def handle_period_type(update, context):
     is_week = update.message.text == 'Неделя'
     db_processing.add_period_type_to_booking(
@@ -232,6 +310,7 @@ def handle_period_type(update, context):
     return States.INPUT_PERIOD_LENGTH
 
 
+@with_draft_session
 def handle_period_length(update, context):
     input_period = int(update.message.text)
 
@@ -244,10 +323,15 @@ def handle_period_length(update, context):
         update.message.chat_id
     )
 
-    max_period = MAX_PERIOD[current_booking['category']]
-    if (current_booking['period_type'] == 'month' and input_period > max_period):
+    max_period = db_processing.get_max_period(
+        current_booking['category'],
+        current_booking['period_type'],
+    )
+    if input_period > max_period:
+        period_units = (current_booking['period_type'] == 'week'
+                        and 'недель' or 'месяцев')
         update.message.reply_text(
-            f'Максимальный период хранения {max_period} месяцев. '
+            f'Максимальный период хранения {max_period} {period_units}. '
             'Введите период еще раз')
         return States.INPUT_PERIOD_LENGTH
 
@@ -267,10 +351,37 @@ def handle_period_length(update, context):
         current_booking['end_date'],
     )
 
+    is_held = db_processing.hold_free_cells(
+        update.message.chat_id,
+        current_booking['storage_id'],
+        current_booking['category'],
+        current_booking['item_id'],
+        current_booking['count'],
+        current_booking['start_date'],
+        current_booking['end_date'],
+    )
+    if not is_held:
+        free_cells_count = db_processing.get_free_cells_count(
+            current_booking['storage_id'],
+            current_booking['category'],
+            current_booking['item_id'],
+            current_booking['start_date'],
+            current_booking['end_date'],
+            client_id=update.message.chat_id,
+        )
+        update.message.reply_text(
+            dedent(f'''\
+                На весь период хранения на складе свободно {free_cells_count} мест.
+                Введите период покороче или выберите другой склад'''),
+            reply_markup=keyboards.create_other_storage_keyboard()
+        )
+        return States.INPUT_PERIOD_LENGTH
+
     handle_confirm_booking(update, context)
     return States.CONFIRM_BOOKING
 
 
+@with_draft_session
 def handle_confirm_booking(update, context):
     current_booking = db_processing.get_client_current_booking(
         update.message.chat_id
@@ -283,6 +394,7 @@ def handle_confirm_booking(update, context):
     return States.CONFIRM_BOOKING
 
 
+@with_draft_session
 def handle_input_promo_code(update, context):
     update.message.reply_text(
         'Введите ваш промокод'
@@ -290,28 +402,39 @@ def handle_input_promo_code(update, context):
     return States.CHECK_PROMO_CODE
 
 
+@with_draft_session
 def handle_check_promo_code(update, context):
-    promo_code = update.message.text
-    p_code_value, p_code_check = check_input.check_promo_code(promo_code)
-    if not p_code_check:
+    promo_code = update.message.text.strip()
+    client_id = update.message.chat_id
+    current_booking = db_processing.get_client_current_booking(
+        client_id
+    )
+    if current_booking.get('promo_code_name') == promo_code:
+        p_code_value = current_booking['promo_code']
+    else:
+        p_code_value = db_processing.reserve_promo_code(promo_code, client_id)
+    if p_code_value is None:
         update.message.reply_text(
             dedent(f'''\
-                Вы ввели несуществующий промокод.
+                Промокод не существует или уже не действует.
                 Вы ввели: {promo_code}
                 Попробуйте еще раз. Нажав на кнопку "Ввести промокод" '''))
 
         handle_confirm_booking(update, context)
         return States.CONFIRM_BOOKING
 
-    client_id = update.message.chat_id
-    current_booking = db_processing.get_client_current_booking(
-        client_id
-    )
+    if current_booking.get('promo_code_name') != promo_code:
+        db_processing.release_promo_code(client_id, current_booking)
     db_processing.update_current_booking(
         client_id,
         'promo_code',
         p_code_value,
     )
+    db_processing.update_current_booking(
+        client_id,
+        'promo_code_name',
+        promo_code,
+    )
     db_processing.update_current_booking(
         client_id,
         'discounted_price',
@@ -324,6 +447,7 @@ def handle_check_promo_code(update, context):
     return States.CONFIRM_BOOKING
 
 
+@with_draft_session
 def handle_start_input_full_name(update, context):
     client_id = update.message.chat_id
     current_booking = db_processing.get_client_current_booking(
@@ -357,6 +481,7 @@ def handle_start_input_full_name(update, context):
     return States.INPUT_SURNAME
 
 
+@with_draft_session
 def handle_input_surname(update, context):
     surname = update.message.text
     if not check_input.check_ru_letters(surname):
@@ -379,6 +504,7 @@ def handle_input_surname(update, context):
     return States.INPUT_NAME
 
 
+@with_draft_session
 def handle_input_name(update, context):
     name = update.message.text
     if not check_input.check_ru_letters(name):
@@ -401,6 +527,7 @@ def handle_input_name(update, context):
     return States.INPUT_SECOND_NAME
 
 
+@with_draft_session
 def handle_input_second_name(update, context):
     second_name = update.message.text
     if not check_input.check_ru_letters(second_name):
@@ -425,6 +552,7 @@ def handle_input_second_name(update, context):
     return States.INPUT_PASSPORT
 
 
+@with_draft_session
 def handle_input_passport(update, context):
     passport = update.message.text
     if not check_input.check_passport(passport):
@@ -450,6 +578,7 @@ def handle_input_passport(update, context):
     return States.INPUT_BIRTH_DATE
 
 
+@with_draft_session
 def handle_input_birth_date(update, context):
     birth_date = update.message.text
     if not check_input.check_birth_date(birth_date):
@@ -479,6 +608,7 @@ def handle_input_birth_date(update, context):
     return States.INPUT_PHONE
 
 
+@with_draft_session
 def handle_input_phone(update, context):
     phone = update.message.text
     client_id = update.message.chat_id
@@ -500,6 +630,7 @@ def handle_input_phone(update, context):
     return States.CLIENT_VERIFY
 
 
+@with_draft_session
 def handle_client_verify(update, context):
     client_id = update.message.chat_id
     current_client = db_processing.get_current_client(client_id)
@@ -526,6 +657,7 @@ def handle_client_verify(update, context):
     )
 
 
+@with_draft_session
 def handle_add_client_to_db(update, context):
     client_id = update.message.chat_id
     current_client = db_processing.get_current_client(client_id)
@@ -543,6 +675,7 @@ def handle_add_client_to_db(update, context):
     return States.PAYMENT
 
 
+@with_draft_session
 def handle_remove_client_info(update, context):
     client_id = update.message.chat_id
     client_param_type = db_processing.client_param_type(client_id)
@@ -591,6 +724,7 @@ def handle_remove_client_info(update, context):
     return States.CLIENT_VERIFY
 
 
+@with_draft_session
 def handle_change_surname(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -603,6 +737,7 @@ def handle_change_surname(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_change_name(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -615,6 +750,7 @@ def handle_change_name(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_change_second_name(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -627,6 +763,7 @@ def handle_change_second_name(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_change_passport(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -641,6 +778,7 @@ def handle_change_passport(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_change_birth_date(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -655,6 +793,7 @@ def handle_change_birth_date(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_change_phone(update, context):
     db_processing.update_current_client(
         update.message.chat_id,
@@ -673,15 +812,19 @@ def handle_change_phone(update, context):
     return States.REMOVE_CLIENT_INFO
 
 
+@with_draft_session
 def handle_qrcode(update, context):
     current_booking = db_processing.get_client_current_booking(
         update.message.chat_id)
 
     if current_booking['status'] == 'payed':
         client_id = update.message.chat_id
-        passport_series_and_number = db_processing.get_passport(client_id)
-
-        access_code = qr.create_access_code(passport_series_and_number)
+        access_code = qr.create_access_code(
+            current_booking['booking_id'],
+            current_booking['storage_id'],
+            current_booking['start_date'],
+            current_booking['end_date'],
+        )
         current_booking["access_code"] = access_code
 
         db_processing.set_booking_access_code(
@@ -689,21 +832,85 @@ def handle_qrcode(update, context):
             access_code
         )
 
-        message_text = (
-            f'Вот ваш электронный ключ для доступа к вашему личному складу. '
-            f'Вы сможете попасть на склад в любое время в период '
-            f'с {current_booking["start_date"]} по {current_booking["end_date"]}'
+        send_access_qrcode(context.bot, client_id, current_booking)
+
+    return handle_cancel(update, context)
+
+
+def send_access_qrcode(bot, client_id, booking):
+    """Sends access QR-code, uploading it only once per booking."""
+    caption = db_processing.create_access_message(booking)
+    if booking.get('qrcode_file_id'):
+        bot.send_photo(
+            chat_id=client_id,
+            photo=booking['qrcode_file_id'],
+            caption=caption,
+        )
+        return
+
+    def save_file_id(message_future):
+        if message_future.exception() is None:
+            message = message_future.result()
+            db_processing.set_booking_qrcode_file_id(
+                booking['booking_id'],
+                message.photo[-1].file_id,
+            )
+
+    def send_rendered_qrcode(qrcode_future):
+        try:
+            qrcode_image = qrcode_future.result()
+        except Exception:
+            logger.exception(
+                f'Failed to render QR-code of booking {booking["booking_id"]} '
+                'in worker, render it inline'
+            )
+            try:
+                qrcode_image = qr.create_qrcode(booking['access_code'])
+            except Exception:
+                logger.exception(
+                    f'Failed to render QR-code of booking '
+                    f'{booking["booking_id"]}'
+                )
+                bot.send_message(
+                    chat_id=client_id,
+                    text=dedent(f'''\
+                        Не удалось подготовить QR-код для доступа на склад.
+                        Получите его позже командой /key {booking['booking_id']}'''),
+                )
+                return
+        message_future = bot.send_photo(
+            chat_id=client_id,
+            photo=qrcode_image,
+            caption=caption,
         )
-        context.bot.send_message(chat_id=client_id, text=message_text)
+        message_future.add_done_callback(save_file_id)
+
+    qr.render_qrcode(booking['access_code']).add_done_callback(
+        send_rendered_qrcode
+    )
+
+
+@with_draft_session
+def handle_resend_qrcode(update, context):
+    client_id = update.message.chat_id
+    booking_id = context.args and context.args[0]
+    booking = booking_id and db_processing.get_booking(booking_id)
 
-        qrcode_image_path = qr.create_qrcode(access_code)
-        with open(qrcode_image_path, 'rb') as qrcode_image:
-            context.bot.send_photo(chat_id=client_id, photo=qrcode_image)
-        os.remove(qrcode_image_path)
+    if (not booking or booking['client_id'] != str(client_id)
+            or not booking.get('access_code')):
+        update.message.reply_text(
+            dedent('''\
+                Не нашли оплаченный заказ с таким номером.
+                Номера ваших заказов можно посмотреть командой /bookings''')
+        )
+    else:
+        booking['booking_id'] = booking_id
+        send_access_qrcode(context.bot, client_id, booking)
 
     return handle_cancel(update, context)
 
 
+@with_draft_session
 def start_without_shipping_callback(update, context):
     """Sends an invoice without shipping-payment."""
     global provider_token
@@ -713,7 +920,7 @@ def start_without_shipping_callback(update, context):
 
     title = "Оплата бронирования"
     description = f"Оплата категории {current_booking['category']}"
-    payload = BOT_PAYLOAD
+    payload = f'{BOT_PAYLOAD}_{current_booking["booking_id"]}'
     currency = "RUB"
     price = current_booking['discounted_price']
     prices = [LabeledPrice("Test", int(price * 100))]
@@ -725,41 +932,145 @@ def start_without_shipping_callback(update, context):
 def precheckout_callback(update, context):
     """Answers the PreQecheckoutQuery"""
     query = update.pre_checkout_query
-    # check the payload, is this from your bot?
-    if query.invoice_payload != BOT_PAYLOAD:
-        # answer False pre_checkout_query
-        query.answer(ok=False, error_message="Something went wrong...")
+    # accept payment only for the booking the client is filling in now
+    booking_id = db_processing.get_pending_booking_id(query.from_user.id)
+    if (booking_id is None
+            or query.invoice_payload != f'{BOT_PAYLOAD}_{booking_id}'):
+        query.answer(
+            ok=False,
+            error_message=('Заказ больше не действует. '
+                           'Оформите бронирование заново командой /start'),
+        )
 
     else:
         query.answer(ok=True)
 
 
+@with_draft_session
 def successful_payment_callback(update, context):
     client_id = update.message.chat_id
     current_booking = db_processing.get_client_current_booking(client_id)
-
-    db_processing.update_current_booking(
-        client_id,
-        'status',
-        'payed'
-    )
-    db_processing.change_of_payment_status(current_booking['booking_id'])
+    payment = update.message.successful_payment
+    if not current_booking or 'booking_id' not in current_booking:
+        logger.error(
+            f'Payment {payment.telegram_payment_charge_id} of {client_id} '
+            f'for {payment.invoice_payload} has no booking in progress'
+        )
+        _, booking_id = payment.invoice_payload.rsplit('_', 1)
+        if db_processing.get_booking(booking_id):
+            db_processing.mark_booking_refund_required(booking_id)
+        update.message.reply_text(
+            dedent('''\
+                Оплата получена, но заказ уже не действует.
+                Мы свяжемся с вами для возврата оплаты.''')
+        )
+        return ConversationHandler.END
 
     update.message.reply_text('Оплата прошла успешно')
 
-    db_processing.update_free_cells_count(
+    is_reserved = db_processing.reserve_free_cells(
+        client_id,
         current_booking['storage_id'],
         current_booking['category'],
-        current_booking['item_id'],    
+        current_booking['item_id'],
         current_booking['count'],
+        current_booking['start_date'],
+        current_booking['end_date'],
     )
+    if not is_reserved:
+        db_processing.mark_booking_refund_required(
+            current_booking['booking_id']
+        )
+        update.message.reply_text(
+            dedent('''\
+                К сожалению, пока вы оформляли заказ, свободные места
+                на складе закончились. Мы свяжемся с вами для возврата оплаты.''')
+        )
+        return handle_cancel(update, context)
+
+    db_processing.update_current_booking(client_id, 'is_held', False)
+    db_processing.update_current_booking(client_id, 'status', 'payed')
+    db_processing.commit_promo_code(client_id, current_booking)
+    db_processing.change_of_payment_status(current_booking['booking_id'])
+    db_processing.schedule_booking_expiry(
+        current_booking['booking_id'],
+        current_booking['end_date'],
+    )
+    return handle_qrcode(update, context)
+
+
+def release_expired_bookings(context):
+    released_count = db_processing.release_expired_bookings()
+    if released_count:
+        logger.info(f'Released {released_count} expired bookings')
 
-    handle_qrcode(update, context)
-    return States.CHOOSE_STORAGE
 
+def reap_unpaid_bookings(context):
+    reaped_count = db_processing.reap_unpaid_bookings()
+    if reaped_count:
+        logger.info(f'Removed {reaped_count} unpaid bookings')
 
-def run_bot(tg_token):
-    updater = Updater(tg_token)
+
+def notify_waitlists(context):
+    notify_count = context.job.context
+    for storage_id, category, item_id in db_processing.pop_released_items():
+        free_cells_count = db_processing.get_free_cells_count(
+            storage_id,
+            category,
+            item_id,
+        )
+        if free_cells_count <= 0:
+            continue
+        waiters = db_processing.pop_waiters(
+            storage_id,
+            category,
+            item_id,
+            min(free_cells_count, notify_count),
+        )
+        if not waiters:
+            continue
+        if len(waiters) < free_cells_count and len(waiters) == notify_count:
+            db_processing.mark_cells_released(storage_id, category, item_id)
+        message_text = db_processing.create_waitlist_message(
+            storage_id,
+            category,
+            item_id,
+        )
+        for client_id in waiters:
+            context.bot.send_message(chat_id=int(client_id), text=message_text)
+        logger.info(
+            f'Notified {len(waiters)} waiters of storage_{storage_id}.'
+            f'{category}.item_{item_id}'
+        )
+
+
+def run_bot(tg_token, workers=0, queue_size=1000, webhook_settings=None,
+            stream_shard=None, send_rate=30, chat_send_rate=1,
+            send_workers=None, qrcode_workers=1, expiry_interval=600, waitlist_interval=60,
+            waitlist_notify_count=10):
+    qr.start_qrcode_workers(qrcode_workers)
+    send_queue = SendQueue(
+        global_rate=send_rate,
+        chat_rate=chat_send_rate,
+        pool_size=send_workers,
+    )
+    bot = QueuedBot(
+        tg_token,
+        request=Request(
+            con_pool_size=max(workers, 4) + send_queue.pool_size + 4
+        ),
+        send_queue=send_queue,
+    )
+    persistence = RedisPersistence(States)
+    if workers:
+        updater = chat_dispatcher.create_chat_ordered_updater(
+            bot,
+            workers,
+            queue_size,
+            persistence=persistence,
+        )
+    else:
+        updater = Updater(bot=bot, persistence=persistence)
 
     dispatcher = updater.dispatcher
 
@@ -767,6 +1078,15 @@ def run_bot(tg_token):
         entry_points=[
             CommandHandler('start', start),
             CommandHandler('bookings', handle_client_bookings),
+            CommandHandler('key', handle_resend_qrcode),
+            MessageHandler(
+                Filters.regex(r'^[0-9]+\.'),
+                handle_storage_choice
+            ),
+            MessageHandler(
+                Filters.successful_payment,
+                successful_payment_callback
+            ),
         ],
         states={
             States.CHOOSE_STORAGE: [
@@ -796,6 +1116,10 @@ def run_bot(tg_token):
                     Filters.regex('^Выбрать другой склад$'),
                     handle_other_storage
                 ),
+                MessageHandler(
+                    Filters.regex('^Встать в лист ожидания$'),
+                    handle_join_waitlist
+                ),
                 MessageHandler(
                     Filters.regex(r'^[0-9]+$'),
                     handle_input_count
@@ -812,6 +1136,10 @@ def run_bot(tg_token):
                 ),
             ],
             States.INPUT_PERIOD_LENGTH: [
+                MessageHandler(
+                    Filters.regex('^Выбрать другой склад$'),
+                    handle_other_storage
+                ),
                 MessageHandler(
                     Filters.regex(r'^[0-9]+$'),
                     handle_period_length
@@ -921,19 +1249,53 @@ def run_bot(tg_token):
                     successful_payment_callback
                 ),
             ],
+            ConversationHandler.TIMEOUT: [
+                MessageHandler(Filters.all, handle_conversation_timeout),
+            ],
         },
         fallbacks=[
             CommandHandler('start', start),
             CommandHandler('bookings', handle_client_bookings),
+            CommandHandler('key', handle_resend_qrcode),
+            MessageHandler(
+                Filters.successful_payment,
+                successful_payment_callback
+            ),
             MessageHandler(Filters.regex('^Отмена$'), handle_cancel),
             MessageHandler(Filters.text & ~Filters.command, handle_unknown)
         ],
+        conversation_timeout=db_processing.get_session_ttl(),
+        name=db_processing.BOOKING_CONVERSATION,
+        persistent=True,
     )
     dispatcher.add_handler(conv_handler)
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    updater.job_queue.run_repeating(
+        release_expired_bookings,
+        interval=expiry_interval,
+        first=0,
+    )
+    updater.job_queue.run_repeating(
+        reap_unpaid_bookings,
+        interval=expiry_interval,
+        first=0,
+    )
+    updater.job_queue.run_repeating(
+        notify_waitlists,
+        interval=waitlist_interval,
+        context=waitlist_notify_count,
+    )
 
-    updater.start_polling()
-    updater.idle()
+    if stream_shard is not None:
+        update_stream.run_worker(updater, stream_shard)
+    elif webhook_settings:
+        webhook.run_webhook(updater, **webhook_settings)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    send_queue.stop()
+    qr.stop_qrcode_workers()
 
 
 def main():
@@ -947,8 +1309,45 @@ def main():
 
     global provider_token
     provider_token = os.environ['PROVIDER_TOKEN']
-
-    run_bot(tg_token)
+    # access codes are signed after payment, fail at startup instead
+    qr.get_signing_key_id()
+
+    bot_mode = os.getenv('BOT_MODE', default='polling')
+    webhook_settings = {
+        'listen': os.getenv('WEBHOOK_LISTEN', default='0.0.0.0'),
+        'port': int(os.getenv('WEBHOOK_PORT', default=8443)),
+        'url_path': os.getenv('WEBHOOK_PATH', default=f'/{tg_token}'),
+        'webhook_url': os.getenv('WEBHOOK_URL'),
+    }
+    shards_count = int(os.getenv('UPDATE_SHARDS', default=1))
+
+    if bot_mode == 'receiver':
+        update_stream.run_receiver(tg_token, shards_count, **webhook_settings)
+        return
+
+    stream_shard = None
+    # The send limit is per process, sharded workers split Telegram's 30/s
+    default_send_rate = 30
+    if bot_mode == 'worker':
+        stream_shard = int(os.environ['WORKER_SHARD'])
+        default_send_rate = 30 / shards_count
+
+    run_bot(
+        tg_token,
+        workers=int(os.getenv('BOT_WORKERS', default=0)),
+        queue_size=int(os.getenv('BOT_QUEUE_SIZE', default=1000)),
+        webhook_settings=bot_mode == 'webhook' and webhook_settings or None,
+        stream_shard=stream_shard,
+        send_rate=float(os.getenv('SEND_RATE', default=default_send_rate)),
+        chat_send_rate=float(os.getenv('CHAT_SEND_RATE', default=1)),
+        send_workers=int(os.getenv('SEND_WORKERS', default=0)) or None,
+        qrcode_workers=int(os.getenv('QRCODE_WORKERS', default=1)),
+        expiry_interval=int(os.getenv('EXPIRY_INTERVAL', default=600)),
+        waitlist_interval=int(os.getenv('WAITLIST_INTERVAL', default=60)),
+        waitlist_notify_count=int(
+            os.getenv('WAITLIST_NOTIFY_COUNT', default=10)
+        ),
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+import json
+import logging
+import time
+from functools import partial
+
+from redis.exceptions import ResponseError
+from telegram import Bot, Update
+
+import db_processing
+from chat_dispatcher import ChatOrderedDispatcher
+from webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+WORKERS_GROUP = 'bot_workers'
+STREAM_MAX_LENGTH = 100000
+LAG_LOG_INTERVAL = 60
+
+
+def get_stream_name(shard):
+    return f'updates_{shard}'
+
+
+def get_update_shard(update_data, shards_count):
+    chat = Update.de_json(update_data, None).effective_chat
+    if chat is None:
+        return 0
+    return chat.id % shards_count
+
+
+def publish_update(update_data, shards_count):
+    db = db_processing.get_database_connection()
+    shard = get_update_shard(update_data, shards_count)
+    db.xadd(
+        get_stream_name(shard),
+        {'update': json.dumps(update_data)},
+        maxlen=STREAM_MAX_LENGTH,
+        approximate=True,
+    )
+
+
+def get_stream_lag(shard):
+    """Returns pending and not yet delivered updates count of a shard.
+
+    ``lag`` is reported by Redis 7+ only, on older servers it is None.
+    """
+    db = db_processing.get_database_connection()
+    for group in db.xinfo_groups(get_stream_name(shard)):
+        if group['name'] == WORKERS_GROUP:
+            return {'pending': group['pending'], 'lag': group.get('lag')}
+    return {'pending': 0, 'lag': None}
+
+
+def run_receiver(tg_token, shards_count, listen, port, url_path,
+                 webhook_url=None):
+    server = WebhookServer(
+        listen,
+        port,
+        url_path,
+        lambda update_data: publish_update(update_data, shards_count),
+    )
+    if webhook_url:
+        Bot(tg_token).set_webhook(f'{webhook_url}{url_path}')
+
+    logger.info(
+        f'Publish webhook updates from {listen}:{port}{url_path} '
+        f'to {shards_count} shards'
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def get_next_message_id(message_id):
+    milliseconds, sequence = message_id.split('-')
+    return f'{milliseconds}-{int(sequence) + 1}'
+
+
+def ack_trimmed_updates(db, stream, consumer):
+    """Acknowledges pending updates already trimmed from the stream.
+
+    MAXLEN trimming may delete an update that was delivered but not
+    acknowledged. Re-reading it returns no fields, which redis-py
+    cannot parse, so such updates are acknowledged and skipped.
+    """
+    min_id = '-'
+    while True:
+        pending = db.xpending_range(
+            stream,
+            WORKERS_GROUP,
+            min_id,
+            '+',
+            100,
+            consumer,
+        )
+        if not pending:
+            return
+        pipe = db.pipeline(transaction=False)
+        for entry in pending:
+            pipe.xrange(stream, entry['message_id'], entry['message_id'])
+        trimmed_ids = [
+            entry['message_id']
+            for entry, messages in zip(pending, pipe.execute())
+            if not messages
+        ]
+        if trimmed_ids:
+            logger.warning(f'Skip {len(trimmed_ids)} trimmed updates')
+            db.xack(stream, WORKERS_GROUP, *trimmed_ids)
+        min_id = get_next_message_id(pending[-1]['message_id'])
+
+
+def process_stream_update(dispatcher, update, ack):
+    """Processes an update and acknowledges it once handled.
+
+    ChatOrderedDispatcher only queues the update on its thread pool, so
+    the acknowledgement is passed to it and sent from the pool.
+    """
+    if isinstance(dispatcher, ChatOrderedDispatcher):
+        dispatcher.process_update(update, on_processed=ack)
+        return
+    dispatcher.process_update(update)
+    ack()
+
+
+def run_worker(updater, shard):
+    db = db_processing.get_database_connection()
+    stream = get_stream_name(shard)
+    consumer = f'worker_{shard}'
+    try:
+        db.xgroup_create(stream, WORKERS_GROUP, id='0', mkstream=True)
+    except ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+    updater.job_queue.start()
+    logger.info(f'Consume updates from {stream}')
+    # Re-read updates delivered before a restart but never acknowledged
+    ack_trimmed_updates(db, stream, consumer)
+    last_id = '0'
+    lag_logged_at = 0
+    try:
+        while True:
+            try:
+                response = db.xreadgroup(
+                    WORKERS_GROUP,
+                    consumer,
+                    {stream: last_id},
+                    count=100,
+                    block=5000,
+                )
+            except TypeError:
+                # a pending update was trimmed while re-reading
+                ack_trimmed_updates(db, stream, consumer)
+                continue
+            messages = response[0][1] if response else []
+            if last_id != '>':
+                # pending updates may still be processed by the pool, so
+                # the history is read past them instead of from '0' again
+                last_id = messages[-1][0] if messages else '>'
+            for message_id, fields in messages:
+                if not fields:
+                    db.xack(stream, WORKERS_GROUP, message_id)
+                    continue
+                update = Update.de_json(json.loads(fields['update']), updater.bot)
+                process_stream_update(
+                    updater.dispatcher,
+                    update,
+                    partial(db.xack, stream, WORKERS_GROUP, message_id),
+                )
+
+            if time.monotonic() - lag_logged_at > LAG_LOG_INTERVAL:
+                logger.info(f'{stream} lag: {get_stream_lag(shard)}')
+                lag_logged_at = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        updater.job_queue.stop()
+        updater.dispatcher.stop()
@@ -0,0 +1,86 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.send_error(404)
+            return
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            if content_length < 0:
+                raise ValueError('negative Content-Length')
+            update_data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(update_data, dict) or 'update_id' not in update_data:
+            self.send_error(400)
+            return
+
+        try:
+            self.server.enqueue_update(update_data)
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            # Update.de_json fails on objects that are not Telegram updates
+            logger.warning(f'Reject malformed update: {error!r}')
+            self.send_error(400)
+            return
+        except Exception:
+            logger.exception('Failed to enqueue update')
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """HTTP receiver for Telegram updates.
+
+    Each POSTed update is handed to ``enqueue_update`` and acknowledged
+    at once, handlers run later in the dispatcher.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, listen, port, url_path, enqueue_update):
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.url_path = url_path
+        self.enqueue_update = enqueue_update
+
+
+def run_webhook(updater, listen, port, url_path, webhook_url=None):
+    bot = updater.bot
+    dispatcher = updater.dispatcher
+
+    def enqueue_update(update_data):
+        updater.update_queue.put(Update.de_json(update_data, bot))
+
+    server = WebhookServer(listen, port, url_path, enqueue_update)
+    if webhook_url:
+        bot.set_webhook(f'{webhook_url}{url_path}')
+
+    updater.job_queue.start()
+    dispatcher_thread = Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    logger.info(f'Listen for webhook updates on {listen}:{port}{url_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        updater.job_queue.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()